@@ -1,3 +1,4 @@
+import sys
 import logging.config
 from configparser import ConfigParser
 
@@ -15,4 +16,15 @@ def get_config():
 def setup_logging():
     logging.config.fileConfig(LOG_CONFIG_FILE)
 
+def log_to_stderr():
+    """
+    Moves the console handlers set up by logging.conf from stdout to stderr, so
+    stdout only holds output other programs read.
+    """
+    loggers = [logging.getLogger()] + [logging.getLogger(name) for name in logging.root.manager.loggerDict]
+    for logger in loggers:
+        for handler in getattr(logger, 'handlers', []):
+            if isinstance(handler, logging.StreamHandler) and handler.stream is sys.stdout:
+                handler.setStream(sys.stderr)
+
 CONFIG = create_config()
@@ -1,19 +1,35 @@
 import time
 import logging
+import threading
 import logging.config
 import requests as r, json, os, urllib.parse, utilities.utilities as util, argparse, sys
-from oauth.datalakeoauth import OAuthResources, OAuthPayload, OAuthRequest, OAuthEndpoints
+from oauth.datalakeoauth import OAuthResources, OAuthPayload, OAuthRequest, OAuthEndpoints, DEFAULT_POOL_SIZE
 from datetime import datetime
 from metadata import datalakemetadata as dlmd
+from utilities.schemaregistry import SchemaRegistry
+from utilities.schemawriters import SchemaWriterPool
+from utilities.statestore import ExtractionStateStore, DONE, FAILED
+from utilities.scheduling import schedule, ExtractionProgress, LARGEST_FIRST
+from utilities.parsing import parse_object
+from utilities.idset import IdSet
+from utilities.parquetio import ParquetWriterPool, arrow_types, parquet_compression, PARQUET, CSV
+from utilities.runcontext import RunContext, run_context, set_run_context
+from utilities.rawarchive import RawArchive, ArchivedResponse
 from pathlib import Path
 from resources.dictdefinitions import DatalakeExtractionContext
-from typing import List
+from typing import List, NamedTuple
 from abc import ABC, abstractmethod
-from config.config import get_config, setup_logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from config.config import get_config, setup_logging, log_to_stderr
 
 CONFIG = get_config()
 setup_logging()      
 
+WATERMARK_PROPERTY = 'dl_timestamp'
+# Full load run ids are the start time of the load with this prefix.
+FULL_LOAD_RUN = 'full-'
+
 class DatalakeEndpoints:
     _BASE    = 'https://mingle35-ionapi.inforgov.com/{tenant_name}/IONSERVICES/datalakeapi/v1'
     _BASE_V2 = 'https://mingle35-ionapi.inforgov.com/{tenant_name}/IONSERVICES/datalakeapi/v2'
@@ -53,6 +69,35 @@ class DatalakeQuery(ABC):
 
         return self
 
+    def process_async(self, filepath) -> threading.Thread:
+        """
+        Writes the data to file on a background thread so the caller can keep
+        working with the data in memory. The thread holds its own reference to the
+        data until the file is written, so the caller may drop it right away.
+        Returns the thread so the caller can wait for the file before reading it.
+        """
+        data = self.data
+
+        def write():
+            try:
+                with open(f'{filepath}', 'w') as file:
+                    json.dump(data, file)
+            except Exception as e:
+                logging.error(f'Error writing {filepath}: {e}')
+
+        thread = threading.Thread(target=write, name=f'checkpoint-{os.path.basename(filepath)}')
+        thread.start()
+        return thread
+
+class DataObject(NamedTuple):
+    """
+    Entry in the data object listing of a business class. Holds only the
+    properties of a data object that the extraction needs.
+    """
+    dl_id: str
+    dl_instance_count: int
+    dl_timestamp: str
+
 class DataObjectProperties(DatalakeQuery):
     """
     Represents a datalake objects properties. The properties of a datalake object
@@ -75,10 +120,7 @@ class DataObjectProperties(DatalakeQuery):
             filter=f'({urllib.parse.quote(filter)})'
         )
 
-        response = r.get(
-            url,
-            headers = {'Authorization': f'Bearer {self.oauth_request.oauth_token.access_token}'}
-        )
+        response = self.oauth_request.session.get(url)
 
         if response.status_code != 200:
             raise Exception(response.text)
@@ -91,35 +133,80 @@ class DataObjectProperties(DatalakeQuery):
             num_records=batch_size
         )
 
-        response = r.get(
-            url,
-            headers = {'Authorization': f'Bearer {self.oauth_request.oauth_token.access_token}'}
-        )
+        response = self.oauth_request.session.get(url)
 
         if response.status_code != 200:
             raise Exception(response.text)
         
         return json.loads(response.content.decode("utf-8"))
 
-
-        pass
+    def objects(self) -> List[DataObject]:
+        """
+        Returns the compiled data object properties as a list of DataObject.
+        """
+        return [
+            DataObject(obj['dl_id'], obj.get('dl_instance_count', 0), obj.get('dl_timestamp'))
+            for obj in self.data['fields']
+        ]
 
 class DatalakeOptions:
     """
     Represents the available command line options to datalakewrapper.py
     and stores their True or False values for easier access.
     """
-    def __init__(self, generate_schemas: bool, extract_data: bool, incremental_load: bool, full_load: bool):
+    def __init__(self, generate_schemas: bool, extract_data: bool, incremental_load: bool, full_load: bool, max_workers: int = 1,
+                 stream_responses: bool = False, watermark: bool = False, bc_workers: int = 1,
+                 retry_failed: bool = False, plan: bool = False, parse_workers: int = 0, output_format: str = CSV,
+                 reprocess: bool = False, retry_mismatches: bool = False):
         self.generate_schemas = generate_schemas
         self.extract_data = extract_data
         self.incremental_load = incremental_load
         self.full_load = full_load
+        self.max_workers = max(1, max_workers)
+        self.stream_responses = stream_responses
+        self.watermark = watermark
+        self.bc_workers = max(1, bc_workers)
+        self.retry_failed = retry_failed
+        self.plan = plan
+        self.parse_workers = max(0, parse_workers)
+        self.output_format = output_format
+        self.reprocess = reprocess
+        self.retry_mismatches = retry_mismatches
 
 class BusinessClass:
-    def __init__(self, name=None, schemas=None, data=None):
+    def __init__(self, name=None, schemas=None, data=None, objects=None, run_id=None):
         self.name = name
         self.schemas = schemas
         self.data = data
+        self.objects = objects
+        self.run_id = run_id
+        self.selected_columns = None
+        self.registry = SchemaRegistry(schemas) if schemas is not None else None
+        # Recorded count of the objects extracted again for a record count mismatch, by id.
+        self.mismatches = {}
+
+    @property
+    def objects(self):
+        return self._objects
+
+    @objects.setter
+    def objects(self, objects):
+        self._objects = objects
+        self._instance_counts = None
+
+    def instance_counts(self) -> dict:
+        """
+        Returns the record count listed for each data object by id. If the business
+        class has not been listed, only the objects extracted again for a record
+        count mismatch have a count. Built once per listing and shared by every
+        caller, so it must not be modified.
+        """
+        if self._instance_counts is None:
+            if self._objects is None:
+                self._instance_counts = self.mismatches
+            else:
+                self._instance_counts = {obj.dl_id: obj.dl_instance_count for obj in self._objects}
+        return self._instance_counts
 
 class DatalakeServiceBase:
     """
@@ -139,6 +226,7 @@ class DatalakeServiceBase:
         self.extraction_groups = self.config.get('extractions', 'active').split('\n')
         self.bc_iter = self.__get_business_classes()
         self.bc_filter = util.create_filter('dl_document_name')('eq')
+        self.watermark_filter = util.create_filter(WATERMARK_PROPERTY)('ge')
         self.curr_bc = None
         self.dl_endpoints = dl_endpoints
         self.oauth_endpoints = oauth_endpoints,
@@ -151,6 +239,16 @@ class DatalakeServiceBase:
         self.data_obj_props = data_obj_props(**self.query_props)
         self.opts = opts
         self.extraction_start_time = None
+        self.writers = None
+        self.parse_pool = None
+        self.parse_schemas = None
+        self.obj_props_checkpoint = None
+        self.state = ExtractionStateStore(
+            self.config.get('filename_templates', 'extraction_state', fallback=os.path.join('tmp', 'extraction_state.db')),
+            batch_size=self.config.getint('extractions', 'state_batch_size', fallback=500)
+        )
+        self.archive = self.new_archive()
+        self.spool_size = self.config.getint('extractions', 'stream_spool_size', fallback=util.STREAM_SPOOL_SIZE)
 
         self.__init_environment()
 
@@ -161,8 +259,74 @@ class DatalakeServiceBase:
         for eg in self.extraction_groups:
             yield self.config.get('extraction_groups', eg).split('\n')
 
+    def new_archive(self) -> RawArchive:
+        """
+        Returns the archive of raw data object bodies if `archive_raw` is set in the
+        extractions section or the business classes are reprocessed, else None.
+        """
+        if not (self.opts.reprocess or self.config.getboolean('extractions', 'archive_raw', fallback=False)):
+            return None
+
+        return RawArchive(
+            self.config.get('filename_templates', 'raw_archive', fallback=os.path.join('tmp', 'raw_archive')),
+            max_bytes=self.config.getint('extractions', 'archive_max_bytes', fallback=0),
+            codec=self.config.get('extractions', 'archive_compression', fallback='gzip')
+        )
+
+    def download(self, object_id: str) -> bytes:
+        """
+        Returns the raw body of a data object. The body is archived if there is an
+        archive, and read from the archive instead of the datalake when reprocessing.
+
+        object_id -- id of object in datalake
+        """
+        if self.opts.reprocess:
+            return self.archive.get(self.curr_bc.name, object_id)
+
+        response = self.oauth_request.session.get(self.dl_endpoints.DATA_OBJECT_BY_ID.format(id=object_id))
+        try:
+            if response.status_code != 200:
+                raise Exception(f'Error sending request to datalake for {response.text.strip()}')
+            body = response.content
+        finally:
+            response.close()
+
+        if self.archive:
+            self.archive.put(self.curr_bc.name, object_id, body)
+        return body
+
+    def fetch_data(self, object_id: str):
+        """
+        Queries the datalake object by ID endpoint and returns the raw response.
+        Safe to call from worker threads since it does not touch business class state.
+        In streaming mode the body is read here into a spooled temporary file, so it is
+        downloaded on the worker thread without being held in memory whole.
+
+        object_id -- id of object in datalake
+        """
+        if self.archive:
+            return ArchivedResponse(self.download(object_id), self.dl_endpoints.DATA_OBJECT_BY_ID.format(id=object_id))
+
+        response = self.oauth_request.session.get(
+            self.dl_endpoints.DATA_OBJECT_BY_ID.format(id=object_id),
+            stream=self.opts.stream_responses
+        )
+        if self.opts.stream_responses and response.status_code == 200:
+            return util.SpooledResponse(response, self.spool_size)
+        return response
+
     @util.write_to_schema_file
     @util.extract
+    def process_data(self, response):
+        """
+        Passes a datalake response through the decorator functions which process
+        and write the data. Must be called in the order the ids are extracted so
+        that new schemas are numbered and written deterministically.
+
+        response -- response returned by `fetch_data`
+        """
+        return response
+
     def query_data(self, object_id: str):
         """
         Queries the datalake object by ID endpoint. This function can be modified to process
@@ -171,16 +335,77 @@ class DatalakeServiceBase:
 
         object_id -- id of object in datalake
         """
-        
-        return r.get(
-            self.dl_endpoints.DATA_OBJECT_BY_ID.format(id=object_id),
-            headers = {'Authorization': f'Bearer {self.oauth_request.oauth_token.access_token}'}
-        )
+        return self.process_data(self.fetch_data(object_id))
+
+    def fetch_and_parse(self, object_id: str):
+        """
+        Downloads a data object and hands its body to the parse pool. Runs on a
+        fetch worker thread. Returns the body and the future of the parsed object.
+
+        object_id -- id of object in datalake
+        """
+        body = self.download(object_id)
+        return body, self.parse_pool.submit(parse_object, body, self.parse_schemas, self.curr_bc.selected_columns)
+
+    def write_parsed(self, body: bytes, parsed) -> List[str]:
+        """
+        Numbers the schema versions of an object parsed by the parse pool and
+        writes its rows. Must be called in id order, like `process_data`. If the
+        object was parsed before another object registered one of its schemas
+        with a different column order, it is parsed again here with the current
+        schemas. Returns the schema versions written.
+
+        body   -- raw body of the data object
+        parsed -- future returned by `fetch_and_parse`
+        """
+        registry = self.curr_bc.registry
+        groups = parsed.result()
+        versions = [registry.version(dict.fromkeys(columns)) for columns, rows in groups]
+
+        if any(registry.columns(v) != columns for v, (columns, rows) in zip(versions, groups)):
+            logging.debug('Schema column order changed while parsing, parsing again')
+            groups = parse_object(body, self.curr_bc.schemas, self.curr_bc.selected_columns)
+
+        # Workers parse later objects with the schemas known so far.
+        if len(registry) != len(self.parse_schemas):
+            self.parse_schemas = dict(self.curr_bc.schemas)
+
+        written = set()
+        for version, (columns, rows) in zip(versions, groups):
+            if version != '0' and self.writers and self.writers.write(self.curr_bc.name, version, rows):
+                written.add(version)
+
+        return sorted(written, key=int)
+
+    def prefetch(self, ids, executor, depth: int, fetch=None):
+        """
+        Submits requests for the given ids to the executor while keeping at most
+        `depth` requests in flight. Yields (id, future) pairs in the same order as
+        the ids so responses can be processed in order while others download.
+
+        ids      -- iterable of data object ids
+        executor -- executor used to run `fetch`
+        depth    -- maximum number of outstanding requests
+        fetch    -- function run for each id, `fetch_data` by default
+        """
+        fetch = fetch or self.fetch_data
+        in_flight = deque()
+        for object_id in ids:
+            in_flight.append((object_id, executor.submit(fetch, object_id)))
+            if len(in_flight) >= depth:
+                yield in_flight.popleft()
+
+        while in_flight:
+            yield in_flight.popleft()
 
     def post_extract_process(func):
         def wrapper(self, *args, **kwargs):
             context = func(self, *args, **kwargs)
 
+            # Later steps read the object properties file, so make sure it is written.
+            if self.obj_props_checkpoint:
+                self.obj_props_checkpoint.join()
+
             # Update schemas json file
             with open(context['filename_templates']['schemas'].format(business_class=self.curr_bc.name), 'w') as f:
                 f.write(json.dumps(self.curr_bc.schemas))
@@ -188,16 +413,52 @@ class DatalakeServiceBase:
             # Write extracted ids to history
             if self.opts.incremental_load:
                 with open(self.filenames['bc_inc_extraction_history'].format(business_class=self.curr_bc.name), 'a') as f:
-                    f.write(''.join(context['ids_extracted']))
-                
-            with open(self.filenames['bc_extraction_history'].format(business_class=self.curr_bc.name), 'a') as f:
-                f.write(''.join(context['ids_extracted']))
+                    context['ids_extracted'].write(f)
+
+            # The history file is exported from the state store so it includes ids done by a resumed run.
+            self.state.export_history(self.curr_bc.name, self.filenames['bc_extraction_history'].format(business_class=self.curr_bc.name))
+
+            # A retry of failed objects does not list the business class, so it cannot move the watermark.
+            if self.uses_watermark(self.curr_bc.name) and self.curr_bc.objects is not None:
+                self.advance_watermark(self.curr_bc, context['ids_failed'])
+
+            self.state.finish_run(self.curr_bc.name, self.curr_bc.run_id)
+
+            # Pass context to next function in post-extract phase.
+            return context
         return wrapper
 
     def post_extract_validate(func):
         def wrapper(self, *args, **kwargs):
             context = func(self, *args, **kwargs)
-            validation_results = util.record_count_by_bc(self.curr_bc.name)
+
+            # Only a listed full or incremental load can be validated: a retry or a reprocess
+            # does not list the business class, so there is nothing to compare the files with.
+            if self.opts.retry_failed or self.opts.reprocess or self.curr_bc.objects is None:
+                return context
+
+            # The data files hold the objects extracted in this run (and the runs it resumed).
+            counts = self.curr_bc.instance_counts()
+            extracted = self.state.ids(self.curr_bc.name, DONE, run_id=self.curr_bc.run_id)
+            if any(id not in counts for id in extracted):
+                logging.warning(f"{self.curr_bc.name}: Not validating record counts, objects of this run are no longer listed")
+                return context
+
+            # Validation only reports; objects whose counts mismatch were already recorded while extracting.
+            mismatches = self.state.mismatches(self.curr_bc.name, self.curr_bc.run_id)
+            if mismatches:
+                logging.warning(f"{self.curr_bc.name}: {len(mismatches)} object(s) were extracted with a different record count than listed")
+
+            try:
+                validation_results = util.record_count_by_bc(
+                    self.curr_bc.name,
+                    expected=sum(counts[id] for id in extracted),
+                    incremental=self.opts.incremental_load
+                )
+            except (OSError, ValueError) as e:
+                logging.warning(f"{self.curr_bc.name}: Could not validate record counts: {e}")
+                return context
+
             file_rec_count, expected_count, match = validation_results['file_extract_record_count'],\
                                                     validation_results['expected_record_count'],\
                                                     validation_results['match']
@@ -215,33 +476,93 @@ class DatalakeServiceBase:
         which are used to query the datalake for data object properties in chunks.
         The chunks are then grouped together. This grouping makes up the list of ids
         that are needed to fetch data from datalake.
+
+        The chunks are queried concurrently by up to `max_workers` threads and merged
+        in the order of the filters.
         """
-        filters = [f['queryFilter'].replace('(', '').replace(')','') for f in self.data_obj_props.query_split(self.bc_filter(self.curr_bc.name))]
-        self.data_obj_props.data = self.data_obj_props.query(filters.pop(0))
-        for f in filters:
-            data = self.data_obj_props.query(f)
-            for object_id in data['fields']:
-                self.data_obj_props.data['fields'].append(object_id)
+        filters = [f['queryFilter'].replace('(', '').replace(')','') for f in self.data_obj_props.query_split(self.listing_filter(self.curr_bc))]
+        logging.info(f"Listing data objects with {len(filters)} filter(s)...")
+
+        with ThreadPoolExecutor(max_workers=max(1, min(self.opts.max_workers, len(filters)))) as executor:
+            chunks = executor.map(self.data_obj_props.query, filters)
+            self.data_obj_props.data = next(chunks, {'fields': []})
+            for data in chunks:
+                self.data_obj_props.data['fields'].extend(data['fields'])
     
+    def uses_watermark(self, business_class: str) -> bool:
+        """
+        Incremental loads list only the objects newer than the business class's watermark
+        if `--wm` is passed or the business class has `watermark` set in the table config map.
+        """
+        return self.opts.incremental_load and (self.opts.watermark or util.is_watermarked(business_class))
+
+    def listing_filter(self, bc: BusinessClass) -> str:
+        """
+        Returns the datalake filter used to list the data objects of a business class.
+        """
+        bc_filter = self.bc_filter(bc.name)
+        if not self.uses_watermark(bc.name):
+            return bc_filter
+
+        watermark = self.state.watermark(bc.name)
+        if not watermark:
+            logging.info(f"No watermark for {bc.name}, listing all data objects...")
+            return bc_filter
+
+        logging.info(f"Listing data objects of {bc.name} with {WATERMARK_PROPERTY} from {watermark}...")
+        return f"{bc_filter} and {self.watermark_filter(watermark)}"
+
+    def advance_watermark(self, bc: BusinessClass, ids_failed: List[str]):
+        """
+        Moves the watermark of a business class to the newest object listed in this run,
+        but never past the oldest object that failed, so failures are listed again.
+        Objects at the watermark are listed again and dropped by the extraction state.
+        """
+        failed = {id.strip() for id in ids_failed}
+        timestamps = [(obj.dl_timestamp, obj.dl_id) for obj in bc.objects if obj.dl_timestamp is not None]
+        oldest_failure = min((ts for ts, id in timestamps if id in failed), default=None)
+        candidates = [ts for ts, id in timestamps if oldest_failure is None or ts < oldest_failure]
+
+        if candidates:
+            self.state.set_watermark(bc.name, max(candidates))
+            logging.info(f"Watermark of {bc.name} is now {max(candidates)}")
+
+    def checkpoint(self):
+        """
+        Flushes the rows written so far to disk, then commits the queued status
+        updates with the position each data file ends at, so a data object is only
+        recorded as done once its rows are on disk and a resumed extraction can
+        remove the rows written after the last checkpoint.
+        """
+        if not self.writers:
+            return self.state.flush()
+
+        offsets = self.writers.offsets()
+        self.state.checkpoint(self.curr_bc.name, self.curr_bc.run_id, offsets)
+
     def set_up(self, bc=None):
         if not bc:
             bc = self.curr_bc
 
-        # Write data object properties to file.
-        self.compile_data_obj_props()
-        self.data_obj_props.process(self.filenames['obj_props'].format(business_class=bc.name))
+        if self.opts.retry_failed:
+            return self.set_up_retry(bc)
+        if self.opts.reprocess:
+            return self.set_up_reprocess(bc)
 
-        # Load data object properties from file into memory.
-        with open(self.filenames['obj_props'].format(business_class=bc.name), 'r') as file:
-            obj_props = json.load(file)
-            ids = (obj['dl_id'] for obj in obj_props['fields'])
+        # Keep the data object listing in memory; the file is only a checkpoint written in the background.
+        self.compile_data_obj_props()
+        bc.objects = self.data_obj_props.objects()
+        self.obj_props_checkpoint = self.data_obj_props.process_async(self.filenames['obj_props'].format(business_class=bc.name))
+        # Only the checkpoint thread keeps the raw listing, until it has been written.
+        self.data_obj_props.data = None
+        ids = (obj.dl_id for obj in bc.objects)
 
         """
         These actions set up the business class depending on the type of load. Usually and incremental
         or full load.
         """
         util.create_columns_file(business_class=bc.name)
-        dlmd.new_dl_metadata_instance()\
+        dlmd.new_dl_metadata_instance(oauth_request=self.oauth_request)\
             .query(bc.name, False).to_csv(self.filenames['bc_metadata_filename'].format(bc_name=bc.name))
         
         # Set up incremental extract folder structure
@@ -249,66 +570,493 @@ class DatalakeServiceBase:
             .format(bc_folder=bc.name, active_inc_id=util.get_active_inc_id())
         Path(folder_name).mkdir(parents=True, exist_ok=True)
         
+        resuming = False
         if self.opts.incremental_load:
-            ids = util.not_extracted_ids(business_class=bc.name)
+            # The history file may have been replaced (e.g. fetched from S3) since the last run.
+            self.state.import_history(bc.name, self.filenames['bc_extraction_history'].format(business_class=bc.name))
+            bc.run_id = str(util.get_active_inc_id())
+            resuming = self.start_run(bc)
+            ids = self.state.not_extracted(bc.name, ids)
         elif self.opts.full_load:
-            util.remove_data_by_schema_files(business_class=bc.name)
-            # util.reset_schema_file(business_class=bc.name)
-            util.clear_extract_history(business_class=bc.name)
+            # A full load keeps its run id until it finishes, so running it again after a crash resumes it.
+            last_run = self.state.last_run(bc.name, FULL_LOAD_RUN)
+            if last_run and not last_run[1]:
+                bc.run_id = last_run[0]
+            else:
+                util.remove_data_by_schema_files(business_class=bc.name)
+                # util.reset_schema_file(business_class=bc.name)
+                util.clear_extract_history(business_class=bc.name)
+                self.state.clear(bc.name)
+                bc.run_id = FULL_LOAD_RUN + self.extraction_start_time
+            resuming = self.start_run(bc)
+            ids = self.state.not_extracted(bc.name, ids)
+
+        util.create_versioned_files(business_class=bc.name, truncate=not resuming)
+
+        self.load_schemas(bc)
+
+        return ids
+
+    def start_run(self, bc: BusinessClass) -> bool:
+        """
+        Records the start of an extraction of a business class along with the size
+        of its data files. If an unfinished extraction with the same run id is
+        resumed, its data files are truncated back to its last checkpoint, keeping
+        the rows of the objects recorded as done and dropping the rest. Returns True
+        when resuming.
+        """
+        csv_output = self.opts.output_format != PARQUET
+        filename = util.schema_filename_resolver(self.filenames, self.opts.incremental_load, self.opts.full_load)
+        resuming = self.state.start_run(bc.name, bc.run_id, util.data_file_sizes(filename, bc.name) if csv_output else None)
+
+        if resuming:
+            logging.info(f"Resuming unfinished extraction {bc.run_id} of {bc.name}...")
+            if csv_output:
+                truncated = util.truncate_data_files(filename, bc.name, self.state.offsets(bc.name, bc.run_id))
+                if truncated:
+                    logging.info(f"Removed the rows written after the last checkpoint from {len(truncated)} file(s)")
 
-        util.create_versioned_files(business_class=bc.name)
+        return resuming
 
+    def load_schemas(self, bc: BusinessClass):
+        """
+        Loads the schema versions of a business class and the columns of the columns
+        file, so only those columns are formatted and written during extraction.
+        """
         bc.schemas = util.get_schemas(bc.name)
+        bc.selected_columns = util.columns_to_extract(bc.name)
+        if bc.selected_columns:
+            logging.info(f"Extracting only the columns listed in the columns file of {bc.name}...")
+        bc.registry = SchemaRegistry(bc.schemas, project=lambda columns: util.project_columns(columns, bc.selected_columns))
+
+    def set_up_retry(self, bc: BusinessClass):
+        """
+        Sets up a business class to extract only the objects in its failure queue,
+        and with `retry_mismatches` the objects recorded with a record count
+        mismatch. The business class is not listed again and rows are appended to
+        the files of the current incremental or full load.
+        """
+        folder_name = self.filenames['inc_data_active_id']\
+            .format(bc_folder=bc.name, active_inc_id=util.get_active_inc_id())
+        Path(folder_name).mkdir(parents=True, exist_ok=True)
+
+        if self.opts.incremental_load:
+            bc.run_id = str(util.get_active_inc_id())
+        else:
+            last_run = self.state.last_run(bc.name, FULL_LOAD_RUN)
+            bc.run_id = last_run[0] if last_run else FULL_LOAD_RUN + self.extraction_start_time
+        self.start_run(bc)
+        util.create_versioned_files(business_class=bc.name, truncate=False)
+
+        self.load_schemas(bc)
+
+        failures = self.state.failures(bc.name)
+        logging.info(f"Retrying {len(failures)} failed object(s) of {bc.name}...")
+        ids = [dl_id for dl_id, attempts, last_error in failures]
+
+        if self.opts.retry_mismatches:
+            # Their rows are checked against the recorded count, and the mismatch is cleared once they match.
+            bc.mismatches = {dl_id: expected for dl_id, expected, written in self.state.mismatches(bc.name)}
+            failed = set(ids)
+            ids += [dl_id for dl_id in bc.mismatches if dl_id not in failed]
+            logging.info(f"Extracting {len(bc.mismatches)} object(s) of {bc.name} with a record count mismatch again...")
+
+        return ids
+
+    def set_up_reprocess(self, bc: BusinessClass):
+        """
+        Sets up a business class to have its full load files rebuilt from its archived
+        data objects, without contacting the datalake, whatever its type of load.
+        Schema versions keep their numbers, and the extraction history, state and
+        watermark are left as they are, and only the archived objects recorded as
+        extracted are reprocessed, so the set of extracted objects does not change.
+        Objects extracted but no longer archived (evicted, or extracted before
+        archiving was on) are logged, since the rebuilt files will not hold their rows.
+        """
+        done = set(self.state.ids(bc.name, DONE))
+        archived = self.archive.ids(bc.name)
+        ids = [id for id in archived if id in done]
+
+        missing = len(done) - len(ids)
+        if missing:
+            logging.warning(f"{missing} extracted object(s) of {bc.name} are not in the archive and will be missing from the rebuilt files")
+        if len(archived) > len(ids):
+            logging.info(f"Skipping {len(archived) - len(ids)} archived object(s) of {bc.name} that are not recorded as extracted")
+
+        util.remove_data_by_schema_files(business_class=bc.name)
+        bc.run_id = self.extraction_start_time
+        self.state.start_run(bc.name, bc.run_id)
+        util.create_versioned_files(business_class=bc.name, truncate=True, incremental=False)
+
+        self.load_schemas(bc)
 
+        logging.info(f"Reprocessing {len(ids)} archived object(s) of {bc.name}...")
         return ids
 
+    def new_writers(self, filename):
+        """
+        Returns the writers of the current business class's data files in the
+        configured output format.
+
+        filename -- function returned by `util.schema_filename_resolver`
+        """
+        if self.opts.output_format != PARQUET:
+            return SchemaWriterPool(filename, compression_options=util.compression_options())
+
+        registry = self.curr_bc.registry
+        return ParquetWriterPool(
+            filename,
+            columns=lambda business_class, version: registry.extracted_columns(version),
+            types=arrow_types(util.get_metadata(self.curr_bc.name)),
+            compression=parquet_compression(util.output_compression())
+        )
+
+    def extract_ids(self, ids: List[str]) -> tuple:
+        """
+        Downloads the given objects on worker threads and processes the responses
+        here, in id order. Records the outcome of every object in the state store.
+        Returns the set of ids extracted and the list of ids that failed.
+
+        ids -- ids of the data objects to extract
+        """
+        ids_extracted = IdSet()
+        ids_failed = []
+        id_count = len(ids)
+        counter = 0
+        instance_counts = self.curr_bc.instance_counts()
+        progress = ExtractionProgress(ids, instance_counts)
+
+        # Objects are parsed in the parse pool when there is one; the fetch window bounds
+        # how many are downloaded or parsed ahead of the object being written.
+        pipelined = self.parse_pool is not None
+        fetch = self.fetch_and_parse if pipelined else self.fetch_data
+        depth = max(self.opts.max_workers, self.opts.parse_workers) * 2
+
+        # The rows written for each object are checked against the record count the datalake lists.
+        reconcile = self.writers is not None and bool(instance_counts) and \
+            self.config.getboolean('extractions', 'reconcile_counts', fallback=True)
+
+        # An object that fails part way has its rows removed so a retry does not duplicate them.
+        # Only streamed csv objects and parquet output can fail after rows have been written.
+        transactional = self.writers is not None and (
+            self.opts.output_format == PARQUET or (self.opts.stream_responses and not pipelined)
+        )
+
+        max_workers = self.opts.max_workers
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for id, future in self.prefetch(ids, executor, depth=depth, fetch=fetch):
+                logging.debug(id)
+
+                try:
+                    if transactional:
+                        self.writers.begin()
+                    rows_before = self.writers.rows_written if reconcile else 0
+                    if pipelined:
+                        versions = self.write_parsed(*future.result())
+                    else:
+                        versions = self.process_data(future.result())
+                    if transactional:
+                        self.writers.commit()
+                    if reconcile:
+                        self.reconcile(id, self.writers.rows_written - rows_before, instance_counts)
+                    progress.update(id)
+                except Exception as e:
+                    logging.error(f'Error querying data for object id: {id}: {e}')
+                    logging.debug(e)
+                    if transactional:
+                        self.writers.rollback()
+                    ids_failed.append(f'{id}\n')
+                    self.state.mark(self.curr_bc.name, id, FAILED, run_id=self.curr_bc.run_id, error=str(e))
+                    with open(f'tmp/{self.curr_bc.name}_ids_extracted.csv', 'a+') as f:
+                        ids_extracted.write(f)
+                    continue
+                else:
+                    ids_extracted.add(id)
+                    self.state.mark(self.curr_bc.name, id, DONE, ','.join(versions), self.curr_bc.run_id)
+                    if counter % 100 == 0 or counter == id_count-1:
+                        logging.info(f"Processing id {counter} / {id_count-1}... {progress}")
+                    counter += 1
+                finally:
+                    if self.state.batch_full:
+                        self.checkpoint()
+
+        return ids_extracted, ids_failed
+
+    def reconcile(self, id: str, rows: int, instance_counts: dict) -> bool:
+        """
+        Records a mismatch in the state store if the number of rows written for a
+        data object differs from the record count the datalake lists for it. The
+        rows are kept, so the object is only extracted again by `--rf --mismatches`,
+        which clears the mismatch once the counts match. Objects without a listed
+        count are not checked. Returns False if the counts differ.
+
+        id              -- id of the data object
+        rows            -- number of rows written for the object
+        instance_counts -- record count of each data object by id
+        """
+        expected = instance_counts.get(id)
+        if expected is None:
+            return True
+        if rows == expected:
+            if id in self.curr_bc.mismatches:
+                self.state.clear_mismatch(self.curr_bc.name, id)
+            return True
+
+        logging.warning(f'Record count mismatch for object id: {id}: expected {expected} records, wrote {rows}')
+        self.state.record_mismatch(self.curr_bc.name, id, expected, rows, self.curr_bc.run_id)
+        return False
+
+    def retry_failures(self, ids_failed: List[str]) -> tuple:
+        """
+        Extracts the failed objects of the current business class again, up to
+        `retry_passes` times, waiting `retry_backoff` seconds before the first pass
+        and doubling the wait before each of the next ones, up to `retry_backoff_max`.
+        Returns the set of ids extracted and the list of ids that still fail.
+
+        ids_failed -- ids that failed, one per line
+        """
+        # Archived objects that failed will fail the same way again.
+        passes = 0 if self.opts.reprocess else self.config.getint('extractions', 'retry_passes', fallback=1)
+        backoff = self.config.getfloat('extractions', 'retry_backoff', fallback=30)
+        backoff_max = self.config.getfloat('extractions', 'retry_backoff_max', fallback=600)
+
+        ids_extracted = IdSet()
+        for retry_pass in range(1, passes + 1):
+            if not ids_failed:
+                break
+
+            wait = min(backoff_max, backoff * 2 ** (retry_pass - 1))
+            logging.info(f"Retrying {len(ids_failed)} failed id(s) of {self.curr_bc.name} in {wait:g}s (pass {retry_pass} / {passes})...")
+            time.sleep(wait)
+
+            extracted, ids_failed = self.extract_ids([id.strip() for id in ids_failed])
+            ids_extracted.update(extracted)
+
+        return ids_extracted, ids_failed
+
+    @post_extract_validate
     @post_extract_process
-    # @post_extract_validate
-    def process_bc(self) -> DatalakeExtractionContext:
+    def process_bc(self, bc: BusinessClass = None) -> DatalakeExtractionContext:
         """
         Iterates through the object ids of the current business class and
-        extracts data from datalake using those ids.
+        extracts data from datalake using those ids. If a business class is
+        given it becomes the current business class.
 
         Returns a dict containing useful context for the next function in the 
         post-extract phase. 
         """
-        ids = self.set_up(self.curr_bc)
-        ids_as_list = list(ids)
-        id_count = sum(1 for val in ids_as_list)
+        if bc:
+            self.curr_bc = bc
+        # Largest objects go first so a big one is not left downloading alone at the end.
+        ids_as_list = schedule(
+            self.set_up(self.curr_bc),
+            self.curr_bc.instance_counts(),
+            self.config.get('extractions', 'schedule', fallback=LARGEST_FIRST)
+        )
+        id_count = len(ids_as_list)
         logging.info(f"Found {id_count} ids...")
 
-        ids_extracted = []
-        counter = 0
+        # Schema files stay open for the whole business class and are closed even on failure.
+        filename = util.schema_filename_resolver(self.filenames, self.opts.incremental_load, self.opts.full_load)
+        self.writers = self.new_writers(filename) if filename else None
 
-        for id in ids_as_list:
-            logging.debug(id)
+        # Downloads run on worker threads, parsing in the parse pool if there is one;
+        # rows are written here, in id order.
+        logging.info(f"Extracting with {self.opts.max_workers} worker(s) and {self.opts.parse_workers} parse process(es)...")
+        if self.opts.parse_workers:
+            self.parse_pool = ProcessPoolExecutor(max_workers=self.opts.parse_workers)
+            self.parse_schemas = dict(self.curr_bc.schemas)
+        started = time.perf_counter()
+        chars_written = 0
+        try:
+            ids_extracted, ids_failed = self.extract_ids(ids_as_list)
+            retried, ids_failed = self.retry_failures(ids_failed)
+            ids_extracted.update(retried)
+        finally:
+            if self.parse_pool:
+                self.parse_pool.shutdown(cancel_futures=True)
+                self.parse_pool = None
+            self.checkpoint()
+            if self.writers:
+                chars_written = self.writers.chars_written
+                self.writers.close()
+                self.writers = None
 
-            try:
-                self.query_data(object_id=id)
-            except Exception as e:
-                logging.error(f'Error querying data for object id: {id}')
-                with open(f'tmp/{self.curr_bc.name}_ids_extracted.csv', 'a+') as f:
-                    f.write(''.join(ids_extracted))
-                continue
-            else:
-                ids_extracted.append(f'{id}\n')
-                if counter % 100 == 0 or counter == id_count-1:
-                    logging.info(f"Processing id {counter} / {id_count-1}...")
-                counter += 1
+        if ids_failed:
+            logging.warning(f"{len(ids_failed)} of {id_count} ids failed to extract for {self.curr_bc.name}")
+
+        # Throughput of this run is used by --plan to estimate later runs.
+        counts = self.curr_bc.instance_counts()
+        records = sum(counts.get(id, 0) for id in ids_extracted)
+        if records:
+            self.state.record_run_stats(self.curr_bc.name, self.curr_bc.run_id, len(ids_extracted), records,
+                                        chars_written, time.perf_counter() - started)
 
         return {
             'business_class': self.curr_bc,
             'ids_extracted': ids_extracted,
+            'ids_failed': ids_failed,
             'filename_templates': self.filenames
         }
 
+    def plan_bc(self, bc: BusinessClass) -> dict:
+        """
+        Lists the data objects of a business class without extracting them and
+        estimates the size and duration of extracting the ones not yet extracted,
+        from the throughput of previous runs of the business class (or of every
+        business class if it has none).
+        """
+        self.curr_bc = bc
+        self.compile_data_obj_props()
+        bc.objects = self.data_obj_props.objects()
+        self.data_obj_props.data = None
+        counts = bc.instance_counts()
+        ids = [obj.dl_id for obj in bc.objects]
+
+        if self.opts.incremental_load:
+            # A dry run: the history file is compared with the state store, not imported into it.
+            ids = self.state.planned_not_extracted(bc.name, ids, self.filenames['bc_extraction_history'].format(business_class=bc.name))
+
+        records = sum(counts.get(id, 0) for id in ids)
+        throughput = self.state.throughput(bc.name) or self.state.throughput()
+        records_per_second, bytes_per_record = throughput or (None, None)
+
+        return {
+            'business_class': bc.name,
+            'objects': len(bc.objects),
+            'instances': sum(obj.dl_instance_count for obj in bc.objects),
+            'not_extracted': len(ids),
+            'records_to_extract': records,
+            'estimated_bytes': int(records * bytes_per_record) if throughput else None,
+            'estimated_seconds': round(records / records_per_second, 1) if throughput else None
+        }
+
+    def plan(self) -> dict:
+        """
+        Plans the extraction of the active extraction groups without downloading
+        any data. The plan is written as json to the `extraction_plan` file and to
+        stdout for the scheduler to read.
+        """
+        plans = []
+        for eg in self.extraction_groups:
+            for bc in self.config.get('extraction_groups', eg).split('\n'):
+                logging.info(f'Planning bc: {bc}')
+                plans.append(self.plan_bc(BusinessClass(name=bc)))
+
+        def total(key):
+            values = [p[key] for p in plans]
+            return None if None in values else sum(values)
+
+        plan = {
+            'created_at': datetime.now().isoformat(),
+            'load': 'incremental' if self.opts.incremental_load else 'full',
+            'business_classes': plans,
+            'totals': {
+                key: total(key) for key in
+                ('objects', 'instances', 'not_extracted', 'records_to_extract', 'estimated_bytes', 'estimated_seconds')
+            }
+        }
+
+        filename = self.config.get('filename_templates', 'extraction_plan', fallback=os.path.join('tmp', 'extraction_plan.json'))
+        with open(filename, 'w') as f:
+            json.dump(plan, f, indent=2)
+        print(json.dumps(plan, indent=2))
+
+        return plan
+
+    def reprocess_bc(self, bc: BusinessClass) -> str:
+        """
+        Rebuilds the data files by schema, the schemas json file and the merged file
+        of a business class from its archived data objects. Returns the merged file.
+        """
+        self.process_bc(bc)
+        logging.info(f"Merging the rebuilt data files of {bc.name}...")
+        return util.bc_merged_csv(bc.name, incremental=False)()
+
     def process_multiple_bc(self):
+        if self.opts.bc_workers > 1:
+            return self.process_multiple_bc_parallel()
+
+        process = self.reprocess_bc if self.opts.reprocess else self.process_bc
         for eg in self.extraction_groups:
             logging.info(f'Processing extraction group: {eg}')
             for bc in self.config.get('extraction_groups', eg).split('\n'):
                 logging.info(f'Processing bc: {bc}')
-                self.curr_bc = BusinessClass(name=bc)
-                self.process_bc()
+                process(BusinessClass(name=bc))
+
+    def process_multiple_bc_parallel(self):
+        """
+        Fans the business classes of the active extraction groups out to `bc_workers`
+        processes. Each process builds its own service, so business class state and
+        output files are isolated. Raises once every business class has finished if
+        any of them failed.
+        """
+        bc_names = [bc for eg in self.extraction_groups for bc in self.config.get('extraction_groups', eg).split('\n')]
+        logging.info(f'Processing {len(bc_names)} bcs with {self.opts.bc_workers} processes...')
+
+        # Refresh the token now so every worker loads the same valid token from the token file.
+        # Reprocessing reads the archive only, so it needs no token.
+        if not self.opts.reprocess:
+            self.oauth_request.oauth_token
+
+        # Workers use this process's run context so they all extract to the same incremental id.
+        context = run_context()
+
+        failed = []
+        with ProcessPoolExecutor(max_workers=self.opts.bc_workers) as executor:
+            futures = {executor.submit(process_bc_in_worker, bc, self.opts, context): bc for bc in bc_names}
+            for future in as_completed(futures):
+                bc = futures[future]
+                try:
+                    future.result()
+                except Exception as e:
+                    logging.error(f'Error processing bc {bc}: {e}')
+                    failed.append(bc)
+                else:
+                    logging.info(f'Finished bc: {bc}')
+
+        if failed:
+            raise Exception(f'Failed to process bcs: {", ".join(failed)}')
+
+def new_datalake_service(opts: DatalakeOptions, config=None) -> DatalakeServiceBase:
+    """
+    Create all dependencies for datalake servers and return the datalake service.
+    """
+    config = config or CONFIG
+    tenant_name = config.get('env_vars', 'active_tenant')
+    datalake_endpoints = DatalakeEndpoints(tenant_name=tenant_name)
+    oauth_endpoints = OAuthEndpoints(tenant_name=tenant_name)
+    oauth_resources = OAuthResources(config.get('filename_templates', 'oauth_credentials'))
+    oauth_payloads = OAuthPayload(oauth_resources)
+    oauth_request = OAuthRequest(oauth_payloads, oauth_endpoints)
+
+    # Every endpoint shares one pooled session; size it to the requests in flight.
+    oauth_request.configure_session(pool_size=max(DEFAULT_POOL_SIZE, opts.max_workers * 2), processes=opts.bc_workers)
+
+    return DatalakeServiceBase(
+        config=config,
+        dl_endpoints=datalake_endpoints,
+        oauth_endpoints=oauth_endpoints,
+        oauth_resources=oauth_resources,
+        oauth_request=oauth_request,
+        data_obj_props = DataObjectProperties,
+        opts=opts
+    )
+
+def process_bc_in_worker(bc_name: str, opts: DatalakeOptions, context: RunContext = None) -> str:
+    """
+    Extracts one business class in a worker process with its own datalake service.
+    The OAuth token is loaded from the token file kept fresh by the parent process,
+    and the run context is the parent's.
+    """
+    if context is not None:
+        set_run_context(context)
+    dl_service = new_datalake_service(opts)
+    if opts.reprocess:
+        dl_service.reprocess_bc(BusinessClass(name=bc_name))
+    else:
+        dl_service.process_bc(BusinessClass(name=bc_name))
+    return bc_name
 
 def main():
     """
@@ -318,19 +1066,26 @@ def main():
     logging.debug(args)
     start_time = time.perf_counter()
 
-    tenant_name = CONFIG.get('env_vars', 'active_tenant')
-    datalake_endpoints = DatalakeEndpoints(tenant_name=tenant_name)
-    oauth_endpoints = OAuthEndpoints(tenant_name=tenant_name)
-    oauth_resources = OAuthResources(CONFIG.get('filename_templates', 'oauth_credentials'))
-    oauth_payloads = OAuthPayload(oauth_resources)
-    oauth_request = OAuthRequest(oauth_payloads, oauth_endpoints)
-    data_obj_props = DataObjectProperties
+    # Read the table config and freeze the incremental id for the whole run.
+    set_run_context(RunContext.build(CONFIG))
+
     dl_options = DatalakeOptions(
         **{
             'generate_schemas': args.gs,
             'extract_data': args.ed,
-            'incremental_load': args.il,
-            'full_load': args.fl
+            # Reprocessing rebuilds the files of a full load.
+            'incremental_load': args.il and not args.rp,
+            'full_load': args.fl or args.rp,
+            'max_workers': args.workers or CONFIG.getint('extractions', 'max_workers', fallback=1),
+            'stream_responses': args.stream or CONFIG.getboolean('extractions', 'stream_responses', fallback=False),
+            'watermark': args.wm or CONFIG.getboolean('extractions', 'watermark', fallback=False),
+            'bc_workers': args.bc_workers or CONFIG.getint('extractions', 'bc_workers', fallback=1),
+            'retry_failed': args.rf,
+            'plan': args.plan,
+            'reprocess': args.rp,
+            'retry_mismatches': args.mismatches,
+            'output_format': CONFIG.get('extractions', 'output_format', fallback=CSV),
+            'parse_workers': args.parse_workers if args.parse_workers is not None else CONFIG.getint('extractions', 'parse_workers', fallback=0)
         }
     )
 
@@ -344,20 +1099,15 @@ def main():
         then the script is exited since the token is required for any 
         interactions with the datalake
         """
-        dl_service = DatalakeServiceBase(
-            config=CONFIG,
-            dl_endpoints=datalake_endpoints,
-            oauth_endpoints=oauth_endpoints,
-            oauth_resources=oauth_resources,
-            oauth_request=oauth_request,
-            data_obj_props = data_obj_props,
-            opts=dl_options
-        )
+        dl_service = new_datalake_service(dl_options)
     except SystemExit as e:
         logging.error(f'Could not get OAuth token.\n{e.message}')
     else:
         try:
-            dl_service.process_multiple_bc()
+            if dl_options.plan:
+                dl_service.plan()
+            else:
+                dl_service.process_multiple_bc()
         except Exception as e:
             logging.error(e)
             raise e
@@ -374,7 +1124,19 @@ if __name__ == '__main__':
     parser.add_argument('--ed', help='Extract data from datalake', action='store_true')
     parser.add_argument('--il', help='Perform incremental data extraction', action='store_true')
     parser.add_argument('--fl', help='Perform full wipe/replace data extraction', action='store_true')
+    parser.add_argument('--workers', help='Number of data objects to download concurrently', type=int)
+    parser.add_argument('--stream', help='Parse datalake responses as they stream in', action='store_true')
+    parser.add_argument('--wm', help='List only data objects newer than the watermark on incremental loads', action='store_true')
+    parser.add_argument('--rf', help='Retry only the data objects that failed to extract. Use with --il or --fl', action='store_true')
+    parser.add_argument('--mismatches', help='With --rf, also extract again the data objects recorded with a record count mismatch', action='store_true')
+    parser.add_argument('--rp', help='Rebuild the data files, schemas and merged file of each business class from the raw archive without contacting the datalake', action='store_true')
+    parser.add_argument('--plan', help='List the active business classes and print an extraction plan as json without extracting', action='store_true')
+    parser.add_argument('--parse-workers', help='Number of processes parsing data objects. 0 parses them on the main thread', type=int)
+    parser.add_argument('--bc-workers', help='Number of business classes to extract in parallel processes', type=int)
     args = parser.parse_args()
+    # The plan is printed as json on stdout, so the logs go to stderr.
+    if args.plan:
+        log_to_stderr()
     logging.info(args)
 
     # Run main
@@ -28,10 +28,7 @@ class APIExtractor(DataExtractor):
         self.endpoints = endpoints
 
     def get(self, url):
-        response = r.get(
-            url,
-            headers = {'Authorization': f'Bearer {self.oauth_request.oauth_token.access_token}'}    
-        )
+        response = self.oauth_request.session.get(url)
        
         return response
 
@@ -180,6 +177,7 @@ if __name__ == '__main__':
     with open('agencies.csv', 'r') as f1:
         agencies = [agy.strip() for agy in f1.readlines()]    
     urls = list(map(lambda agency: url.format(agency=agency), agencies))
+    oauth_request.configure_session(pool_size=len(agencies))
 
     # Create and start threads
     threads = []
@@ -6,7 +6,9 @@ Pulls a CSV file from S3, performs lightweight munging, and loads it into SQL.
 - slineses and jrgarrar
 """
 
+import io
 import os
+import gzip
 import json
 import boto3
 import time
@@ -131,10 +133,14 @@ def data_import(db_table_name, s3_object, sql_to_python_dict, verbose=False):
     logging.info(s3_object)
     data = s3_object.get()["Body"]
 
-    # Load CSV as a dataframe, catching warnings without writing to STDERR
-    with warnings.catch_warnings():
-        warnings.simplefilter(action='ignore')
-        df = pd.read_csv(data, dtype=dtype, low_memory=True, verbose=verbose)
+    # Parquet files are already typed; only the columns in the table are read
+    if s3_object.key.endswith(".parquet"):
+        df = read_parquet(data, dtype)
+    else:
+        # Load CSV as a dataframe, catching warnings without writing to STDERR
+        with warnings.catch_warnings():
+            warnings.simplefilter(action='ignore')
+            df = pd.read_csv(decompressed(data, s3_object.key), dtype=dtype, low_memory=True, verbose=verbose)
 
 
     # Noting missing columns (in metadata but not in data)
@@ -165,6 +171,38 @@ def data_import(db_table_name, s3_object, sql_to_python_dict, verbose=False):
     return df
 
 
+def decompressed(data, key):
+    """
+    Returns a stream of the decompressed data of a gzip (.gz) or zstd (.zst) CSV
+    file, or the data itself if it is not compressed. The files are written as
+    several concatenated gzip members or zstd frames, which are read as one stream.
+    """
+    if key.endswith(".gz"):
+        return gzip.GzipFile(fileobj=data, mode="rb")
+    if key.endswith(".zst"):
+        import zstandard
+
+        return zstandard.ZstdDecompressor().stream_reader(data, read_across_frames=True)
+    return data
+
+
+def read_parquet(data, dtype):
+    """
+    Loads a parquet file as a dataframe, reading only the columns of the staging
+    table and casting them to the same types as a CSV import would.
+    """
+    import pyarrow.parquet as pq
+
+    parquet_file = pq.ParquetFile(io.BytesIO(data.read()))
+    columns = [col for col in parquet_file.schema_arrow.names if col in dtype]
+    skipped = [col for col in parquet_file.schema_arrow.names if col not in dtype]
+    if skipped:
+        logging.warning(f"Logging columns visible in data but not present in metadata: {skipped}")
+
+    df = parquet_file.read(columns=columns).to_pandas()
+    return df.astype({col: dtype[col] for col in columns})
+
+
 def data_munge(df, sql_keyword_list):
     """
     Clean the incoming data by removing duplicate values, scrubbing nulls,
@@ -25,10 +25,7 @@ class DatalakeMetadata(DatalakeQuery):
         """
         url = self.endpoint.format(object_name=object_name)
 
-        response = r.get(
-            url,
-            headers = {'Authorization': f'Bearer {self.oauth_request.oauth_token.access_token}'}
-        )
+        response = self.oauth_request.session.get(url)
 
         if response.status_code == 200:
             data = json.loads(response.content.decode("utf-8"))
@@ -54,13 +51,14 @@ class DatalakeMetadata(DatalakeQuery):
         with open(filepath, 'w') as f:
             f.write(json.dumps(self.data))
 
-def new_dl_metadata_instance(active_tenant: str = None) -> 'DatalakeMetadata':
+def new_dl_metadata_instance(active_tenant: str = None, oauth_request=None) -> 'DatalakeMetadata':
     """
-    Returns new instance of DatalakeMetadata.
+    Returns new instance of DatalakeMetadata. Reuses the given oauth request
+    (and its pooled session) if one is supplied.
     """
     dl_metadata = DatalakeMetadata(
     **{
-        "oauth_request": new_oauth_object(get_config(), tenant_name=active_tenant or get_config().get('env_vars', 'active_tenant')), 
+        "oauth_request": oauth_request or new_oauth_object(get_config(), tenant_name=active_tenant or get_config().get('env_vars', 'active_tenant')), 
         "datalake_endpoints": DatalakeCatalogEndpoints(tenant_name=active_tenant or get_config().get('env_vars', 'active_tenant'))
     })
 
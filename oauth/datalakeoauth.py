@@ -1,8 +1,47 @@
 from . import json, time, r, logging, os
 from . import CONFIG, setup_logging, InvalidRefreshTokenError, AccountNotAuthorised
 import threading
+from contextlib import contextmanager
+from requests.adapters import HTTPAdapter
+from .ratelimit import AdaptiveRateLimiter, THROTTLED_STATUSES, retry_after_seconds
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
 
 setup_logging()
+
+DEFAULT_POOL_SIZE = 10
+DEFAULT_MAX_RETRIES = 3
+
+@contextmanager
+def token_file_lock(token_filename: str):
+    """
+    Holds an exclusive lock on `<token file>.lock` shared by every process using the
+    token file, so only one process refreshes the rotating refresh token at a time.
+    """
+    with open(token_filename + '.lock', 'a+b') as lock_file:
+        if fcntl:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        else:
+            lock_file.seek(0)
+            while True:
+                try:
+                    # Retries for 10 seconds before raising.
+                    msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    continue
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+            else:
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
 class OAuthResources:
     """
     Represents the json credentials generated from Infro and provides dot
@@ -122,28 +161,112 @@ class OAuthEndpoints:
     def __getattr__(self, endpoint):
         return self._BASE % endpoint.lower()        
 
+class OAuthSession(r.Session):
+    """
+    Keep-alive session shared by the datalake and FSM clients. Connections to
+    the ION API are pooled and the bearer token of the owning OAuthRequest is
+    added to every request that does not set its own Authorization header.
+
+    Every request goes through the session's rate limiter. Throttled responses
+    (429/503) are retried up to `max_retries` times once the limiter's pause is
+    over, so callers only see them when the API keeps throttling.
+    """
+    def __init__(self, oauth_request: 'OAuthRequest', pool_size: int = DEFAULT_POOL_SIZE,
+                 rate_limiter: AdaptiveRateLimiter = None, max_retries: int = DEFAULT_MAX_RETRIES):
+        super().__init__()
+        self.oauth_request = oauth_request
+        self.pool_size = pool_size
+        self.rate_limiter = rate_limiter or AdaptiveRateLimiter(max_concurrency=pool_size)
+        self.max_retries = max_retries
+
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.mount('https://', adapter)
+        self.mount('http://', adapter)
+
+    def request(self, method, url, **kwargs):
+        headers = kwargs.pop('headers', None) or {}
+        bearer = 'Authorization' not in headers
+        for attempt in range(self.max_retries + 1):
+            if bearer:
+                headers['Authorization'] = f'Bearer {self.oauth_request.oauth_token.access_token}'
+
+            with self.rate_limiter.slot() as result:
+                response = super().request(method, url, headers=headers, **kwargs)
+                result['status_code'] = response.status_code
+                # Time to the headers, so a large body taking long to download does not read as a slow API.
+                result['latency'] = response.elapsed.total_seconds()
+                result['retry_after'] = retry_after_seconds(response.headers.get('Retry-After'))
+
+            if response.status_code not in THROTTLED_STATUSES or attempt == self.max_retries:
+                return response
+
+            logging.warning(f'{response.status_code} from {url}, retrying ({attempt + 1}/{self.max_retries})')
+            response.close()
+
 class OAuthRequest:
     """
     Represents a fully formed OAuth request required to query the datalake.
     """
 
     token_lock = threading.Lock()
+    refresh_lock = threading.Lock()
     def __init__(self, oauth_payloads: OAuthPayload, oauth_endpoints: OAuthEndpoints):
         self.oauth_payloads = oauth_payloads
         self.oauth_endpoints = oauth_endpoints
         self._oauth_token = self.OAuthToken('','','','','')
+        self._http = r.Session()
+        self._session = None
 
-        self._load_token_data() or self.new_access_token()
+        with token_file_lock(self.token_filename):
+            self._load_token_data() or self.new_access_token()
+
+    @property
+    def token_filename(self) -> str:
+        return CONFIG.get('filename_templates', 'datalake_tokens')
 
     @property
     def oauth_token(self):
         """
-        Refreshes token if expired each time the token is retrieved.
+        Refreshes token if expired each time the token is retrieved. Only one
+        thread of one process refreshes, holding the token file lock; the others
+        wait and reuse the refreshed token. The token file is re-read once the lock
+        is held in case another process already refreshed it.
         """
         if self._oauth_token.expires_at <= int(time.time()):
-            self.refresh_access_token()
+            with self.refresh_lock, token_file_lock(self.token_filename):
+                if self._oauth_token.expires_at <= int(time.time()):
+                    self._load_token_data()
+                if self._oauth_token.expires_at <= int(time.time()):
+                    self.refresh_access_token()
         return self._oauth_token
 
+    @property
+    def session(self) -> OAuthSession:
+        """
+        Shared, authenticated session used for every call to the ION API.
+        Created with the default pool size unless `configure_session` was called.
+        """
+        if self._session is None:
+            self.configure_session()
+        return self._session
+
+    def configure_session(self, pool_size: int = DEFAULT_POOL_SIZE, processes: int = 1) -> OAuthSession:
+        """
+        Replaces the shared session with one whose connection pool holds `pool_size`
+        connections. Should be sized to the number of concurrent requests. The rate
+        limits in the `rate_limit` section of the config file are split between
+        `processes` processes.
+        """
+        if self._session is not None:
+            self._session.close()
+        self._session = OAuthSession(
+            self,
+            pool_size=pool_size,
+            rate_limiter=AdaptiveRateLimiter.from_config(CONFIG, max_concurrency=pool_size, processes=processes),
+            max_retries=CONFIG.getint('rate_limit', 'max_retries', fallback=DEFAULT_MAX_RETRIES)
+        )
+        return self._session
+
     @oauth_token.setter
     def oauth_token(self, oauth_token):
         """
@@ -158,11 +281,16 @@ class OAuthRequest:
         self._save_token_data()
 
     def _load_token_data(self):
-        if self.is_file_empty(CONFIG.get('filename_templates', 'datalake_tokens')):
+        if self.is_file_empty(self.token_filename):
             return False
         
-        with open(CONFIG.get('filename_templates', 'datalake_tokens'), 'r') as file:
-            token_data = self.OAuthToken(**json.loads(file.readline()))
+        with open(self.token_filename, 'r') as file:
+            try:
+                token_data = self.OAuthToken(**json.loads(file.readline()))
+            except ValueError as e:
+                # Another process may be midway through writing the file.
+                logging.debug(f'Could not read token file: {e}')
+                return False
             self._oauth_token = token_data
             return True
     
@@ -174,7 +302,7 @@ class OAuthRequest:
         token_req_payload -- required payload to communicate with auth server
         type              -- used to specify refresh or get new auth token. options: (refresh | new)
         """
-        auth_token = r.post(auth_server_url,
+        auth_token = self._http.post(auth_server_url,
             data=token_req_payload
         )
         
@@ -217,9 +345,15 @@ class OAuthRequest:
         )
 
     def _save_token_data(self):
+        """
+        Writes the token to a temporary file and renames it over the token file,
+        so other processes never read a partly written token.
+        """
         with self.token_lock:
-            with open(CONFIG.get('filename_templates', 'datalake_tokens'), 'w') as file:
+            temp_filename = f'{self.token_filename}.{os.getpid()}.tmp'
+            with open(temp_filename, 'w') as file:
                 json.dump(self._oauth_token.__dict__, file)
+            os.replace(temp_filename, self.token_filename)
 
     def is_file_empty(self, file_path: str) -> bool:
         """
@@ -0,0 +1,165 @@
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+"""
+Client side throttling of ION API traffic. A token bucket caps the request rate
+and an AIMD (additive increase, multiplicative decrease) limit adapts the number
+of requests in flight to how the API is responding.
+"""
+
+THROTTLED_STATUSES = (429, 503)
+
+def retry_after_seconds(value: str) -> float:
+    """
+    Parses a Retry-After header, given either in seconds or as an HTTP date.
+    Returns None if the header is missing or cannot be parsed.
+    """
+    if not value:
+        return None
+
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+class AdaptiveRateLimiter:
+    """
+    Shared by every thread making requests through an OAuthSession.
+
+    Requests take a token from a bucket refilled at `rate` tokens per second and
+    holding at most `burst` tokens; a rate of 0 disables the bucket. At most
+    `concurrency` requests are in flight at once. The concurrency limit grows by
+    one for every limit's worth of responses that arrive within `target_latency`,
+    shrinks by `decrease_factor` when responses are slower than that, and halves
+    when the API throttles (429/503). A throttled response also pauses every
+    request for its Retry-After time, or `cooldown` seconds if there is none.
+
+    rate            -- requests per second, 0 for no limit
+    burst           -- maximum number of tokens in the bucket
+    min_concurrency -- lowest the concurrency limit may go
+    max_concurrency -- highest the concurrency limit may go, and where it starts
+    target_latency  -- seconds the headers of a response may take before concurrency is reduced
+    decrease_factor -- factor the limit is multiplied by on slow responses
+    cooldown        -- seconds to pause on a throttled response without Retry-After
+    """
+    def __init__(self, rate: float = 0, burst: int = 1, min_concurrency: int = 1, max_concurrency: int = 16,
+                 target_latency: float = 10.0, decrease_factor: float = 0.9, cooldown: float = 5.0):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.min_concurrency = max(1, min_concurrency)
+        self.max_concurrency = max(self.min_concurrency, max_concurrency)
+        self.target_latency = target_latency
+        self.decrease_factor = decrease_factor
+        self.cooldown = cooldown
+
+        self._limit = float(self.max_concurrency)
+        self._in_flight = 0
+        self._tokens = float(self.burst)
+        self._refilled_at = time.monotonic()
+        self._paused_until = 0.0
+        self._cond = threading.Condition()
+
+    @classmethod
+    def from_config(cls, config, max_concurrency: int = 16, processes: int = 1) -> 'AdaptiveRateLimiter':
+        """
+        Creates a limiter from the `rate_limit` section of the config file. The
+        configured rate and concurrency are split evenly between `processes`
+        processes that share the tenant's quota. `max_concurrency` is used when
+        the config file does not set it.
+        """
+        processes = max(1, processes)
+        section = 'rate_limit'
+        return cls(
+            rate=config.getfloat(section, 'requests_per_second', fallback=0) / processes,
+            burst=config.getint(section, 'burst', fallback=1),
+            min_concurrency=config.getint(section, 'min_concurrency', fallback=1),
+            max_concurrency=max(1, config.getint(section, 'max_concurrency', fallback=max_concurrency * processes) // processes),
+            target_latency=config.getfloat(section, 'target_latency', fallback=10.0),
+            cooldown=config.getfloat(section, 'cooldown', fallback=5.0)
+        )
+
+    @property
+    def limit(self) -> int:
+        return int(self._limit)
+
+    def _refill(self, now: float):
+        if self.rate:
+            self._tokens = min(self.burst, self._tokens + (now - self._refilled_at) * self.rate)
+        self._refilled_at = now
+
+    def _wait_time(self, now: float) -> float:
+        """
+        Seconds to wait before a request may start, or 0 if it may start now.
+        """
+        if now < self._paused_until:
+            return self._paused_until - now
+        if self._in_flight >= self.limit:
+            return None
+        if self.rate and self._tokens < 1:
+            return (1 - self._tokens) / self.rate
+        return 0
+
+    def acquire(self):
+        """
+        Blocks until a request may be sent.
+        """
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                wait = self._wait_time(now)
+                if wait == 0:
+                    break
+                self._cond.wait(wait)
+
+            if self.rate:
+                self._tokens -= 1
+            self._in_flight += 1
+
+    def release(self, status_code: int = None, latency: float = None, retry_after: float = None):
+        """
+        Frees the slot of a finished request and adapts the concurrency limit to
+        its status code and latency.
+        """
+        with self._cond:
+            self._in_flight -= 1
+
+            if status_code in THROTTLED_STATUSES:
+                self._limit = max(self.min_concurrency, self._limit / 2)
+                pause = retry_after if retry_after is not None else self.cooldown
+                self._paused_until = max(self._paused_until, time.monotonic() + pause)
+            elif status_code is None or (latency is not None and latency > self.target_latency):
+                self._limit = max(self.min_concurrency, self._limit * self.decrease_factor)
+            elif status_code < 500:
+                self._limit = min(self.max_concurrency, self._limit + 1 / self._limit)
+
+            self._cond.notify_all()
+
+    @contextmanager
+    def slot(self):
+        """
+        Holds a request slot for the length of the block. The block receives a
+        dict in which it should set the `status_code` and `retry_after` of the
+        response, and may set its `latency`; otherwise the time the block took is
+        used.
+        """
+        self.acquire()
+        result = {'status_code': None, 'retry_after': None, 'latency': None}
+        started = time.monotonic()
+        try:
+            yield result
+        finally:
+            latency = result['latency'] if result['latency'] is not None else time.monotonic() - started
+            self.release(result['status_code'], latency, result['retry_after'])
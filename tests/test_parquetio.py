@@ -0,0 +1,25 @@
+import pytest
+
+pa = pytest.importorskip('pyarrow')
+pytest.importorskip('resources.dictdefinitions')
+
+from utilities import parquetio
+from utilities.utilities import encode_rows
+
+def test_value_that_does_not_fit_its_type_is_kept_as_string(tmp_path):
+    filename = lambda business_class, version: str(tmp_path / f'{business_class}_v{version}.csv')
+    columns = lambda business_class, version: ['a', 'b']
+    pool = parquetio.ParquetWriterPool(filename, columns, {'a': pa.int64(), 'b': pa.string()}, row_group_size=1)
+
+    for rows in ([(1, 'x')], [('not a number', 'y')], [(3, None)]):
+        pool.begin()
+        pool.write('X', '1', encode_rows(rows))
+        pool.commit()
+    pool.close()
+
+    # The typed rows already written stay in the first part; the rest are in a new one.
+    assert len(parquetio.parquet_parts(filename('X', '1'))) == 2
+
+    merged = parquetio.read_parquet_files({'1': filename('X', '1')}, {'1': {}}, ['a', 'b'])
+    assert merged.schema.field('a').type == pa.string()
+    assert merged.to_pydict() == {'a': ['1', 'not a number', '3'], 'b': ['x', 'y', None]}
@@ -0,0 +1,38 @@
+import configparser
+import json
+import pytest
+
+pytest.importorskip('pandas')
+pytest.importorskip('boto3')
+
+import utilities.utilities as util
+from utilities.helpers.push_data import cleansed_s3_path
+from utilities.runcontext import RunContext, set_run_context
+
+@pytest.mark.parametrize('s3_path, expected', [
+    ('output/X_all_schemas.csv', 'output/X_cleansed.csv'),
+    ('output/X_all_schemas.csv.gz', 'output/X_cleansed.csv.gz'),
+    ('output/X_all_schemas.parquet', 'output/X_cleansed.parquet'),
+])
+def test_cleansed_s3_path(s3_path, expected):
+    assert cleansed_s3_path(s3_path) == expected
+
+def test_parquet_upload_matches_db_load_target(tmp_path, monkeypatch):
+    config = configparser.ConfigParser()
+    config.read_dict({
+        'aws': {'s3_databrew_bucket_name': 'databrew'},
+        'extractions': {'output_format': 'parquet'}
+    })
+    monkeypatch.setattr(util, 'get_config', lambda: config)
+
+    table_config = {'X': {'business_class_name': 'X', 'incremental': False, 'staging_table_name': 'X_stg'}}
+    templates = {'bc_db_tbl_payload': str(tmp_path / '{business_class}_db_load_payload.json')}
+    set_run_context(RunContext(1, table_config, templates, {}))
+    try:
+        with open(util.write_db_load_payload('X')) as f:
+            payload = json.load(f)
+    finally:
+        set_run_context(None)
+
+    assert payload['target_file'] == 'output/X_cleansed.parquet'
+    assert cleansed_s3_path('output/X_all_schemas.parquet') == payload['target_file']
@@ -2,6 +2,7 @@ import boto3, os, logging, definitions as defs
 from botocore.exceptions import ClientError
 
 TEMP_DIR = os.path.join(defs.ROOT_DIR, 'tmp')
+CONTENT_TYPES = {'.gz': 'application/gzip', '.zst': 'application/zstd', '.parquet': 'application/vnd.apache.parquet'}
 
 def upload_file(file_name, bucket, object_name=None) -> bool:
     """
@@ -17,11 +18,15 @@ def upload_file(file_name, bucket, object_name=None) -> bool:
     if object_name is None:
         object_name = os.path.basename(file_name)
 
+    # Compressed files are stored as they are, labelled with their content type
+    content_type = CONTENT_TYPES.get(os.path.splitext(file_name)[1])
+    extra_args = {'ContentType': content_type} if content_type else None
+
     # Upload the file
     s3 = boto3.resource('s3')
     bucket = s3.Bucket(bucket)
     try:
-        response = bucket.upload_file(file_name, object_name)
+        response = bucket.upload_file(file_name, object_name, ExtraArgs=extra_args)
     except ClientError as e:
         logging.error(e)
         return False
@@ -0,0 +1,171 @@
+import collections
+import gzip
+import io
+import os
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+"""
+Compressed csv files. Data is compressed in independent blocks on a thread pool,
+as zlib and zstd release the GIL while compressing. Each block is a complete gzip
+member or zstd frame, so the blocks can simply be concatenated: files can be
+appended to and truncated at a block boundary, and any gzip or zstd reader reads
+them as one stream.
+"""
+
+NONE = 'none'
+GZIP = 'gzip'
+ZSTD = 'zstd'
+EXTENSIONS = {GZIP: '.gz', ZSTD: '.zst'}
+DEFAULT_LEVELS = {GZIP: 6, ZSTD: 3}
+BLOCK_SIZE = 1024 * 1024
+
+_executors = {}
+_executors_lock = threading.Lock()
+
+def require_codec(compression: str):
+    if compression not in (NONE, GZIP, ZSTD):
+        raise ValueError(f'Unknown compression: {compression}')
+    if compression == ZSTD and zstandard is None:
+        raise ImportError('zstandard is required to write zstd output. Install it or set compression = gzip.')
+
+def compressed_filename(filename: str, compression: str) -> str:
+    """
+    Returns the name of a file compressed with the given compression.
+    """
+    return filename + EXTENSIONS.get(compression, '')
+
+def compression_of(filename: str) -> str:
+    """
+    Returns the compression of a file from its extension.
+    """
+    for compression, extension in EXTENSIONS.items():
+        if filename.endswith(extension):
+            return compression
+    return NONE
+
+def compress_block(data: bytes, compression: str, level: int) -> bytes:
+    """
+    Compresses a block into a complete gzip member or zstd frame.
+    """
+    if compression == ZSTD:
+        return zstandard.ZstdCompressor(level=level).compress(data)
+
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+def _executor(threads: int) -> ThreadPoolExecutor:
+    with _executors_lock:
+        executor = _executors.get(threads)
+        if executor is None:
+            executor = _executors[threads] = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='compress')
+        return executor
+
+class BlockCompressor(io.BufferedIOBase):
+    """
+    Binary file object that compresses what is written to it in blocks of
+    `block_size` bytes on a shared thread pool and writes the blocks to `raw` in
+    order. At most two blocks per thread are waiting to be written at any time.
+
+    `flush`, `tell` and `truncate` end the current block, so the position returned
+    by `tell` is always a block boundary that can be truncated back to.
+
+    raw         -- binary file the compressed blocks are written to
+    compression -- `gzip` or `zstd`
+    level       -- compression level
+    threads     -- number of threads compressing blocks
+    block_size  -- bytes of data in each block
+    """
+    def __init__(self, raw, compression: str, level: int = None, threads: int = None, block_size: int = BLOCK_SIZE):
+        require_codec(compression)
+        self.raw = raw
+        self.compression = compression
+        self.level = level if level is not None else DEFAULT_LEVELS[compression]
+        self.threads = threads or os.cpu_count() or 1
+        self.block_size = block_size
+        self._buffer = bytearray()
+        self._pending = collections.deque()
+        self._executor = _executor(self.threads)
+
+    def writable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def _submit(self, block: bytes):
+        self._pending.append(self._executor.submit(compress_block, block, self.compression, self.level))
+        while len(self._pending) > 2 * self.threads:
+            self.raw.write(self._pending.popleft().result())
+
+    def write(self, data) -> int:
+        self._buffer += data
+        while len(self._buffer) >= self.block_size:
+            self._submit(bytes(self._buffer[:self.block_size]))
+            del self._buffer[:self.block_size]
+        return len(data)
+
+    def flush(self):
+        if self._buffer:
+            self._submit(bytes(self._buffer))
+            self._buffer.clear()
+        while self._pending:
+            self.raw.write(self._pending.popleft().result())
+        self.raw.flush()
+
+    def tell(self) -> int:
+        self.flush()
+        return self.raw.tell()
+
+    def truncate(self, position: int = None) -> int:
+        self.flush()
+        return self.raw.truncate(position)
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            super().close()
+        finally:
+            self.raw.close()
+
+def _reader(filename: str, compression: str):
+    if compression == ZSTD:
+        require_codec(ZSTD)
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(open(filename, 'rb'), read_across_frames=True, closefd=True))
+    return gzip.open(filename, 'rb')
+
+def open_compressed(filename: str, mode: str = 'r', encoding: str = 'utf-8', newline: str = None, buffering: int = -1,
+                    level: int = None, threads: int = None, block_size: int = BLOCK_SIZE):
+    """
+    Opens a file compressed according to its extension, or a plain file if it has
+    none. Text modes return a text stream over the (de)compressed data; binary
+    modes (`rb`, `wb`, `ab`) return the binary stream.
+
+    filename  -- file to open
+    mode      -- `r`, `w` or `a`, optionally followed by `b`
+    buffering -- buffer size of a plain file
+    level     -- compression level when writing
+    threads   -- number of threads compressing when writing
+    """
+    compression = compression_of(filename)
+    binary = 'b' in mode
+    mode = mode.replace('b', '').replace('t', '')
+
+    if compression == NONE:
+        if binary:
+            return open(filename, mode + 'b', buffering=buffering)
+        return open(filename, mode, encoding=encoding, newline=newline, buffering=buffering)
+
+    if mode == 'r':
+        stream = _reader(filename, compression)
+    else:
+        stream = BlockCompressor(open(filename, mode + 'b'), compression, level, threads, block_size)
+
+    return stream if binary else io.TextIOWrapper(stream, encoding=encoding, newline=newline)
@@ -0,0 +1,122 @@
+import mmap
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple
+
+"""
+Splits large csv files into parts that can be loaded in parallel. Part boundaries
+are found by byte offset on a memory map, so the file is read once, and the byte
+ranges are then copied to the parts in parallel without being decoded.
+"""
+
+COPY_BUFFER_SIZE = 8 * 1024 * 1024
+COUNT_CHUNK_SIZE = 64 * 1024 * 1024
+
+def _count_quotes(mm, start: int, end: int) -> int:
+    count = 0
+    for pos in range(start, end, COUNT_CHUNK_SIZE):
+        count += mm[pos:min(pos + COUNT_CHUNK_SIZE, end)].count(b'"')
+    return count
+
+def _record_end(mm, pos: int, quoted: bool, odd: bool = False) -> int:
+    """
+    Returns the offset just after the end of the first record ending at or after
+    `pos`. Newlines inside quoted values do not end a record if `quoted` is set;
+    `odd` is True if `pos` is inside a quoted value.
+    """
+    while True:
+        newline = mm.find(b'\n', pos)
+        if newline == -1:
+            return len(mm)
+        if quoted:
+            odd ^= bool(_count_quotes(mm, pos, newline) & 1)
+        pos = newline + 1
+        if not odd:
+            return pos
+
+def split_offsets(filename: str, parts: int, header: bool = False, quoted: bool = True) -> Tuple[int, List[Tuple[int, int]]]:
+    """
+    Returns the size of the header and the (start, end) byte range of each part of
+    a file, split into `parts` ranges of about the same size that each end with a
+    whole record. Ranges may be empty if the file has fewer records than parts.
+
+    filename -- file to split
+    parts    -- number of parts
+    header   -- True if the first record is a header that is not part of any range
+    quoted   -- True if values may be quoted and contain newlines (RFC 4180)
+    """
+    size = os.path.getsize(filename)
+    if size == 0:
+        return 0, [(0, 0)] * parts
+
+    with open(filename, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        start = _record_end(mm, 0, quoted) if header else 0
+
+        # Quote parity is tracked from `start` so each boundary only scans forward.
+        bounds, pos, odd = [start], start, False
+        for i in range(1, parts):
+            target = max(start + (size - start) * i // parts, pos)
+            if quoted:
+                odd ^= bool(_count_quotes(mm, pos, target) & 1)
+            pos = _record_end(mm, target, quoted, odd) if target < size else size
+            odd = False
+            bounds.append(pos)
+
+        bounds.append(size)
+
+    return start, list(zip(bounds, bounds[1:]))
+
+def copy_range(source: str, target: str, start: int, end: int, prefix: bytes = b''):
+    """
+    Copies the bytes in [start, end) of `source` to a new `target` file, after
+    `prefix`. Uses `os.sendfile` where the platform supports it.
+    """
+    with open(source, 'rb') as src, open(target, 'wb') as dst:
+        dst.write(prefix)
+        dst.flush()
+
+        offset = start
+        if hasattr(os, 'sendfile'):
+            try:
+                while offset < end:
+                    sent = os.sendfile(dst.fileno(), src.fileno(), offset, min(end - offset, 1 << 30))
+                    if sent == 0:
+                        break
+                    offset += sent
+            except OSError:
+                dst.seek(len(prefix) + offset - start)
+
+        src.seek(offset)
+        buffer = bytearray(COPY_BUFFER_SIZE)
+        view = memoryview(buffer)
+        while offset < end:
+            n = src.readinto(view[:min(COPY_BUFFER_SIZE, end - offset)])
+            if not n:
+                break
+            dst.write(view[:n])
+            offset += n
+
+def split(source: str, targets: List[str], header: bool = False, quoted: bool = True, workers: int = None) -> List[str]:
+    """
+    Splits `source` into one part per target file and returns the target files.
+    Parts are copied in parallel.
+
+    source  -- file to split
+    targets -- files to write the parts to
+    header  -- True to repeat the header (first record) of `source` at the start of every part
+    quoted  -- True if values may be quoted and contain newlines (RFC 4180)
+    workers -- number of parts copied at the same time; one per part by default
+    """
+    header_size, ranges = split_offsets(source, len(targets), header=header, quoted=quoted)
+
+    prefix = b''
+    if header:
+        with open(source, 'rb') as f:
+            prefix = f.read(header_size)
+
+    with ThreadPoolExecutor(max_workers=workers or len(targets) or 1) as executor:
+        futures = [executor.submit(copy_range, source, target, start, end, prefix) for target, (start, end) in zip(targets, ranges)]
+        for future in futures:
+            future.result()
+
+    return targets
@@ -51,6 +51,14 @@ def parse_args():
     args = parser.parse_args()
     return args
 
+def cleansed_s3_path(s3_path: str) -> str:
+    """
+    Returns the S3 path of data that skips DataBrew: `_all_schemas` becomes
+    `_cleansed` whatever the extension (csv, compressed csv or parquet), matching
+    the `target_file` of the DB load payload.
+    """
+    return s3_path.replace('_all_schemas', '_cleansed')
+
 
 # Main Function
 def main(args):
@@ -66,7 +74,7 @@ def main(args):
     logging.info(f"Target S3 Bucket: {args.bucket}")
 
     if args.skip_databrew:
-        args.s3_path = args.s3_path.replace('_all_schemas.csv', '_cleansed.csv')
+        args.s3_path = cleansed_s3_path(args.s3_path)
         upload_file(target_file, args.bucket, args.s3_path)
     else:
         upload_file(target_file, args.bucket, None)
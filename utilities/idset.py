@@ -0,0 +1,116 @@
+import heapq
+from bisect import bisect_left
+from typing import Iterable, Iterator
+
+"""
+Compact set of the ids of the data objects extracted from a business class, which
+can have millions of them; holding them as Python strings costs about 90 bytes each.
+"""
+
+UUID_SIZE = 16
+_DASHES = (8, 13, 18, 23)
+
+def pack_uuid(id: str) -> bytes:
+    """
+    Returns the 16 bytes of a lowercase, hyphenated UUID, or None if the id is not
+    one. Other ids are not packed since they would not be written back unchanged.
+    """
+    if len(id) != 36 or any(id[i] != '-' for i in _DASHES) or id != id.lower():
+        return None
+    try:
+        return bytes.fromhex(id.replace('-', ''))
+    except ValueError:
+        return None
+
+def unpack_uuid(packed: bytes) -> str:
+    h = packed.hex()
+    return f'{h[:8]}-{h[8:12]}-{h[12:16]}-{h[16:20]}-{h[20:]}'
+
+class _Records:
+    """
+    Sequence view of the fixed width records in a bytearray, for bisect.
+    """
+    def __init__(self, data: bytearray):
+        self.data = data
+
+    def __len__(self):
+        return len(self.data) // UUID_SIZE
+
+    def __getitem__(self, i: int) -> bytes:
+        return bytes(self.data[i * UUID_SIZE:(i + 1) * UUID_SIZE])
+
+class IdSet:
+    """
+    Set of data object ids. UUIDs are stored as 16 byte records in one sorted
+    bytearray; any other id is kept as a string in a regular set. Added ids are
+    buffered and merged into the sorted array the next time the set is read.
+
+    Iterating yields the UUIDs in sorted order, then the other ids.
+
+    ids -- ids to add to the set
+    """
+    def __init__(self, ids: Iterable[str] = ()):
+        self._sorted = bytearray()
+        self._pending = bytearray()
+        self._other = set()
+        self.update(ids)
+
+    def add(self, id: str):
+        packed = pack_uuid(id)
+        if packed is None:
+            self._other.add(id)
+        else:
+            self._pending += packed
+
+    def update(self, ids: Iterable[str]):
+        for id in ids:
+            self.add(id)
+
+    def _packed(self) -> Iterator[bytes]:
+        data = self._sorted
+        return (bytes(data[i:i + UUID_SIZE]) for i in range(0, len(data), UUID_SIZE))
+
+    def _compact(self):
+        """
+        Sorts the buffered ids and merges them into the sorted array, dropping duplicates.
+        """
+        if not self._pending:
+            return
+
+        pending = sorted(self._pending[i:i + UUID_SIZE] for i in range(0, len(self._pending), UUID_SIZE))
+        merged = bytearray()
+        last = None
+        for packed in heapq.merge(self._packed(), (bytes(p) for p in pending)):
+            if packed != last:
+                merged += packed
+                last = packed
+
+        self._sorted = merged
+        self._pending = bytearray()
+
+    def __contains__(self, id: str) -> bool:
+        packed = pack_uuid(id)
+        if packed is None:
+            return id in self._other
+
+        self._compact()
+        records = _Records(self._sorted)
+        i = bisect_left(records, packed)
+        return i < len(records) and records[i] == packed
+
+    def __len__(self) -> int:
+        self._compact()
+        return len(self._sorted) // UUID_SIZE + len(self._other)
+
+    def __iter__(self) -> Iterator[str]:
+        self._compact()
+        for packed in self._packed():
+            yield unpack_uuid(packed)
+        yield from self._other
+
+    def write(self, f):
+        """
+        Writes the ids to an open file in the extraction history format, one id per line.
+        """
+        for id in self:
+            f.write(f'{id}\n')
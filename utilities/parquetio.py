@@ -0,0 +1,324 @@
+import glob
+import io
+import logging
+import os
+import threading
+from typing import Callable, Dict, Iterable, List
+from metadata.types import Type
+
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pa_csv = pq = None
+
+"""
+Parquet output for business class data. Used instead of csv when `output_format`
+is `parquet` in the `extractions` section of the config file. Requires pyarrow.
+"""
+
+CSV = 'csv'
+PARQUET = 'parquet'
+ROW_GROUP_SIZE = 100000
+NULL_VALUES = ['']
+DEFAULT_COMPRESSION = 'snappy'
+
+def require_pyarrow():
+    if pa is None:
+        raise ImportError('pyarrow is required to write parquet output. Install it or set output_format = csv.')
+
+def parquet_filename(filename: str) -> str:
+    """
+    Returns the parquet name of a csv filename.
+    """
+    return os.path.splitext(filename)[0] + '.parquet'
+
+def parquet_parts(filename: str) -> List[str]:
+    """
+    Returns the existing parquet files of a csv filename. Parquet files cannot be
+    appended to, so a resumed or retried extraction adds a `.partN.parquet` file.
+    """
+    base = os.path.splitext(filename)[0]
+    parts = glob.glob(glob.escape(base) + '.part*.parquet')
+    parts.sort(key=lambda part: int(part[len(base) + len('.part'):-len('.parquet')]))
+
+    first = base + '.parquet'
+    return ([first] if os.path.exists(first) else []) + parts
+
+def next_parquet_part(filename: str) -> str:
+    """
+    Returns the name of the next parquet file to write for a csv filename.
+    """
+    base = os.path.splitext(filename)[0]
+    if not os.path.exists(base + '.parquet'):
+        return base + '.parquet'
+
+    n = 1
+    while os.path.exists(f'{base}.part{n}.parquet'):
+        n += 1
+    return f'{base}.part{n}.parquet'
+
+def remove_parquet_parts(filename: str):
+    for part in parquet_parts(filename):
+        os.remove(part)
+
+def output_filename(filename: str, output_format: str) -> str:
+    return parquet_filename(filename) if output_format == PARQUET else filename
+
+def parquet_compression(compression: str) -> str:
+    """
+    Returns the parquet column compression for the configured `compression`.
+    Files are snappy compressed unless gzip or zstd is configured.
+    """
+    return compression if compression in ('gzip', 'zstd') else DEFAULT_COMPRESSION
+
+def arrow_types(bc_metadata: dict) -> Dict[str, 'pa.DataType']:
+    """
+    Returns the arrow type of each column of a business class from its datalake
+    metadata. Dates stay strings, as they are in the csv files.
+    """
+    require_pyarrow()
+    types = {str: pa.string(), bool: pa.bool_(), int: pa.int64(), float: pa.float64()}
+
+    return {col: types.get(Type.map_dl_to_py_type(col_metadata), pa.string()) for col, col_metadata in bc_metadata.items()}
+
+def _read_rows(data: bytes, columns: List[str], column_types: Dict[str, 'pa.DataType']) -> 'pa.Table':
+    return pa_csv.read_csv(
+        io.BytesIO(data),
+        read_options=pa_csv.ReadOptions(column_names=columns),
+        parse_options=pa_csv.ParseOptions(newlines_in_values=True),
+        convert_options=pa_csv.ConvertOptions(
+            column_types=column_types,
+            null_values=NULL_VALUES,
+            strings_can_be_null=True,
+            quoted_strings_can_be_null=True
+        )
+    )
+
+def rows_to_table(rows: List[str], columns: List[str], types: Dict[str, 'pa.DataType']) -> 'pa.Table':
+    """
+    Converts csv rows formatted by `encode_rows` to an arrow table with the given
+    columns, typed from the metadata. Columns missing from the metadata are strings,
+    and so is a column with a value that does not fit its type, as the csv output
+    would have taken it.
+    """
+    data = ''.join(rows).encode('utf-8')
+    column_types = {col: types.get(col, pa.string()) for col in columns}
+    try:
+        return _read_rows(data, columns, column_types)
+    except pa.ArrowInvalid:
+        table = _read_rows(data, columns, {col: pa.string() for col in columns})
+
+    for i, col in enumerate(columns):
+        if column_types[col] == pa.string():
+            continue
+        try:
+            table = table.set_column(i, col, table.column(i).cast(column_types[col]))
+        except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+            logging.warning(f'Column {col} has values that are not {column_types[col]}, writing it as strings')
+
+    return table
+
+class ParquetWriterPool:
+    """
+    Drop-in replacement for SchemaWriterPool that writes one parquet file per
+    (business class, schema version). Rows are converted to arrow as they are
+    written and written out in row groups of `row_group_size` rows, so a whole
+    file is never held in memory. Files are only valid once the pool is closed.
+
+    Between `begin` and `commit` rows are kept as text, so `rollback` can drop
+    the rows of a data object that failed part way through.
+
+    A column with a value that does not fit its type is written as strings from
+    then on; a file that already holds it typed is continued in a new part.
+
+    filename       -- function taking (business_class, version) and returning the csv file name
+    columns        -- function taking (business_class, version) and returning the columns written
+    types          -- arrow type of each column, from `arrow_types`
+    row_group_size -- number of rows buffered before a row group is written
+    compression    -- parquet column compression
+    """
+    def __init__(self, filename: Callable[[str, str], str], columns: Callable[[str, str], List[str]],
+                 types: Dict[str, 'pa.DataType'], row_group_size: int = ROW_GROUP_SIZE,
+                 compression: str = DEFAULT_COMPRESSION):
+        require_pyarrow()
+        self.filename = filename
+        self.columns = columns
+        self.types = dict(types)
+        self.row_group_size = row_group_size
+        self.compression = compression
+        self.chars_written = 0
+        self.rows_written = 0
+        self._writers = {}
+        self._rows = {}
+        self._tables = {}
+        self._in_transaction = False
+        self._counts_mark = None
+        self._lock = threading.Lock()
+
+    def _convert(self, keys: List[tuple]):
+        """
+        Converts the buffered rows of the given keys. Nothing is kept unless every
+        key converts, so the rows of one data object are added all or nothing.
+        """
+        converted = []
+        for key in keys:
+            columns = self.columns(*key)
+            if self._rows.get(key) and columns:
+                converted.append((key, rows_to_table(self._rows[key], columns, self.types)))
+
+        for key in keys:
+            self._rows.pop(key, None)
+
+        for key, table in converted:
+            for field in table.schema:
+                if field.type != self.types.get(field.name, pa.string()):
+                    self.types[field.name] = field.type
+
+        for key, table in converted:
+            tables = self._tables.setdefault(key, [])
+            tables.append(table)
+            if sum(t.num_rows for t in tables) >= self.row_group_size:
+                self._write_row_group(key)
+
+    def _write_row_group(self, key: tuple):
+        tables = self._tables.pop(key, None)
+        if not tables:
+            return
+
+        # Tables converted before a column fell back to strings are cast to the latest schema.
+        schema = tables[-1].schema
+        table = pa.concat_tables([t if t.schema.equals(schema) else t.cast(schema) for t in tables])
+
+        writer = self._writers.get(key)
+        if writer is not None and not writer.schema.equals(table.schema):
+            # Rows already written keep their types in the current part.
+            writer.close()
+            writer = None
+        if writer is None:
+            writer = self._writers[key] = pq.ParquetWriter(next_parquet_part(self.filename(*key)), table.schema, compression=self.compression)
+        writer.write_table(table)
+
+    def write(self, business_class: str, version: str, rows: Iterable[str]) -> int:
+        """
+        Adds rows to the file of a business class schema version. Returns the
+        number of rows written.
+        """
+        key = (business_class, version)
+        with self._lock:
+            buffered = self._rows.setdefault(key, [])
+            count = len(buffered)
+            for row in rows:
+                buffered.append(row)
+                self.chars_written += len(row)
+            count = len(buffered) - count
+            self.rows_written += count
+
+            if not self._in_transaction:
+                self._convert([key])
+
+        return count
+
+    def begin(self):
+        with self._lock:
+            self._in_transaction = True
+            self._counts_mark = (self.rows_written, self.chars_written)
+
+    def commit(self):
+        """
+        Converts the rows written since `begin`. Raises if they cannot be converted,
+        in which case `rollback` should be called.
+        """
+        with self._lock:
+            self._in_transaction = False
+            self._convert(list(self._rows))
+
+    def rollback(self):
+        with self._lock:
+            self._rows.clear()
+            self._in_transaction = False
+            if self._counts_mark:
+                self.rows_written, self.chars_written = self._counts_mark
+            self._counts_mark = None
+
+    def flush(self):
+        with self._lock:
+            self._convert(list(self._rows))
+            for key in list(self._tables):
+                self._write_row_group(key)
+
+    def offsets(self) -> dict:
+        """
+        Flushes the buffered rows. Parquet files cannot be truncated, so no
+        positions are returned.
+        """
+        self.flush()
+        return {}
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            with self._lock:
+                for key, writer in self._writers.items():
+                    try:
+                        writer.close()
+                    except Exception as e:
+                        logging.error(f'Error closing parquet file of {self.filename(*key)}: {e}')
+                self._writers.clear()
+                self._tables.clear()
+                self._rows.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def read_parquet_files(filenames: Dict[str, str], renamed: Dict[str, Dict[str, str]], keep: List[str]) -> 'pa.Table':
+    """
+    Reads the parquet files of a business class by schema version and concatenates
+    them into one table with the `keep` columns, missing columns as nulls. Only the
+    kept columns are read from each file.
+
+    filenames -- csv filename of each schema version
+    renamed   -- name in the merged table of each column of a version, by column
+    keep      -- columns of the merged table
+    """
+    require_pyarrow()
+    kept = set(keep)
+    tables = []
+    for version, filename in filenames.items():
+        for part in parquet_parts(filename):
+            # Only the footer is read to find the columns; the other columns are never decoded.
+            columns = [col for col in pq.read_schema(part).names if renamed[version].get(col, col) in kept]
+            table = pq.read_table(part, columns=columns)
+            table = table.rename_columns([renamed[version].get(col, col) for col in table.column_names])
+            tables.append(table.select([col for col in keep if col in table.column_names]))
+
+    if not tables:
+        return pa.table({col: pa.array([], pa.string()) for col in keep})
+
+    # A column written as strings in some files is read as strings from all of them.
+    types = {}
+    for table in tables:
+        for field in table.schema:
+            if field.type != pa.null():
+                types.setdefault(field.name, set()).add(field.type)
+    mixed = {col for col, col_types in types.items() if len(col_types) > 1}
+    if mixed:
+        tables = [
+            table.cast(pa.schema([pa.field(f.name, pa.string()) if f.name in mixed else f for f in table.schema]))
+            for table in tables
+        ]
+
+    try:
+        merged = pa.concat_tables(tables, promote_options='default')
+    except TypeError:
+        merged = pa.concat_tables(tables, promote=True)
+    for col in keep:
+        if col not in merged.column_names:
+            merged = merged.append_column(col, pa.nulls(merged.num_rows, pa.string()))
+
+    return merged.select(keep)
@@ -0,0 +1,43 @@
+import json
+from typing import Dict, List, Tuple
+from utilities.schemaregistry import column_getter
+from utilities.utilities import encode_rows, project_columns
+
+"""
+Parses and formats datalake responses away from the thread that writes them,
+so the CPU bound work can run in a process pool.
+"""
+
+def parse_object(body: bytes, schemas: Dict[str, List[str]], selected: set = None) -> List[Tuple[List[str], List[str]]]:
+    """
+    Parses the NDJSON body of a data object and formats its records as csv rows.
+    Records are grouped by their set of keys. Returns a list of (columns, rows)
+    pairs in the order each set of keys first appears in the body, so the caller
+    numbers new schema versions exactly as it would parsing the records itself.
+
+    Rows of a set of keys found in `schemas` follow the column order of that schema;
+    rows of any other set of keys follow the key order of its first record. Rows
+    only hold the values of the selected columns.
+
+    body     -- raw body of a datalake stream by id response
+    schemas  -- known schema versions of the business class, {version: [columns]}
+    selected -- columns returned by `columns_to_extract`; None keeps every column
+    """
+    known = {frozenset(columns): columns for columns in schemas.values()}
+    groups = {}
+
+    for line in body.split(b'\n'):
+        if not line.strip():
+            continue
+
+        record = json.loads(line.decode('utf-8'))
+        keys = frozenset(record)
+        group = groups.get(keys)
+        if group is None:
+            columns = known.get(keys) or list(record)
+            group = groups[keys] = (columns, column_getter(project_columns(columns, selected)), [])
+
+        group[2].append(group[1](record))
+
+    # The rows of each set of keys are formatted in one call.
+    return [(columns, encode_rows(values)) for columns, getter, values in groups.values()]
@@ -0,0 +1,255 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from typing import List
+from utilities import compression
+
+"""
+Local archive of the raw bodies of datalake data objects, so a business class can
+be rebuilt (e.g. after a parsing fix or a change to its columns file) without
+downloading its objects again. Bodies are stored compressed and addressed by the
+hash of their content, so objects with the same body are stored once.
+"""
+
+class ArchivedResponse:
+    """
+    Stands in for the datalake response of an archived object, with the parts of
+    the `requests` response used to extract it.
+
+    body -- raw body of the data object
+    url  -- url the object was downloaded from, for error messages
+    """
+    status_code = 200
+
+    def __init__(self, body: bytes, url: str = None):
+        self.content = body
+        self.url = url
+
+    @property
+    def text(self) -> str:
+        return self.content.decode('utf-8')
+
+    def iter_lines(self, chunk_size: int = None, delimiter: bytes = None):
+        return iter(self.content.split(delimiter) if delimiter else self.content.splitlines())
+
+    def close(self):
+        pass
+
+class RawArchive:
+    """
+    Content-addressed store of raw data object bodies. A body is stored once under
+    the sha256 of its content, compressed with gzip or zstd, and an SQLite index
+    (WAL mode) maps each data object of a business class to its body.
+
+    Once the bodies take more than `max_bytes` on disk, the least recently used
+    ones are evicted along with the objects that map to them. The total size is
+    kept up to date in the index, so it is not summed for every body archived. Bodies are written to
+    a temporary file and renamed, so an interrupted write never leaves a partial body.
+
+    directory -- directory holding the bodies and the index
+    max_bytes -- most bytes of compressed bodies kept; 0 keeps everything
+    codec     -- `gzip` or `zstd`
+    level     -- compression level
+    """
+    def __init__(self, directory: str, max_bytes: int = 0, codec: str = compression.GZIP, level: int = None):
+        compression.require_codec(codec)
+        os.makedirs(directory, exist_ok=True)
+
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.codec = codec
+        self.level = level if level is not None else compression.DEFAULT_LEVELS[codec]
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(os.path.join(directory, 'index.db'), timeout=60, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._create_tables()
+
+    def _create_tables(self):
+        with self._lock, self._conn:
+            self._conn.executescript('''
+                CREATE TABLE IF NOT EXISTS blobs (
+                    sha256    TEXT PRIMARY KEY,
+                    filename  TEXT NOT NULL,
+                    size      INTEGER NOT NULL,
+                    last_used REAL NOT NULL
+                ) WITHOUT ROWID;
+
+                CREATE INDEX IF NOT EXISTS blobs_last_used
+                    ON blobs (last_used);
+
+                CREATE TABLE IF NOT EXISTS objects (
+                    business_class TEXT NOT NULL,
+                    dl_id          TEXT NOT NULL,
+                    sha256         TEXT NOT NULL,
+                    archived_at    REAL NOT NULL,
+                    PRIMARY KEY (business_class, dl_id)
+                );
+
+                CREATE INDEX IF NOT EXISTS objects_sha256
+                    ON objects (sha256);
+
+                CREATE TABLE IF NOT EXISTS totals (
+                    id    INTEGER PRIMARY KEY CHECK (id = 0),
+                    bytes INTEGER NOT NULL
+                );
+
+                INSERT OR IGNORE INTO totals (id, bytes) SELECT 0, COALESCE(SUM(size), 0) FROM blobs;
+            ''')
+
+    def _add_bytes(self, size: int):
+        self._conn.execute('UPDATE totals SET bytes = bytes + ? WHERE id = 0', (size,))
+
+    def _path(self, filename: str) -> str:
+        return os.path.join(self.directory, filename)
+
+    def put(self, business_class: str, dl_id: str, body: bytes) -> str:
+        """
+        Archives the body of a data object and returns its sha256. The body is only
+        compressed and written if no other object has the same content.
+        """
+        sha256 = hashlib.sha256(body).hexdigest()
+        now = time.time()
+
+        with self._lock:
+            row = self._conn.execute('SELECT filename, size FROM blobs WHERE sha256 = ?', (sha256,)).fetchone()
+        stored = row is not None and os.path.exists(self._path(row[0]))
+
+        if not stored:
+            filename = os.path.join('objects', sha256[:2], sha256 + compression.EXTENSIONS[self.codec])
+            path = self._path(filename)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            data = compression.compress_block(body, self.codec, self.level)
+
+            temp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            with open(temp, 'wb') as f:
+                f.write(data)
+            os.replace(temp, path)
+
+        with self._lock, self._conn:
+            if not stored:
+                # Read again under the lock: another thread may have stored the same body since the check above.
+                current = self._conn.execute('SELECT size FROM blobs WHERE sha256 = ?', (sha256,)).fetchone()
+                self._conn.execute(
+                    'INSERT OR REPLACE INTO blobs (sha256, filename, size, last_used) VALUES (?, ?, ?, ?)',
+                    (sha256, filename, len(data), now)
+                )
+                # A body already counted, or whose file went missing, is replaced.
+                self._add_bytes(len(data) - (current[0] if current else 0))
+            else:
+                self._conn.execute('UPDATE blobs SET last_used = ? WHERE sha256 = ?', (now, sha256))
+
+            previous = self._conn.execute(
+                'SELECT sha256 FROM objects WHERE business_class = ? AND dl_id = ?', (business_class, dl_id)
+            ).fetchone()
+            self._conn.execute(
+                'INSERT OR REPLACE INTO objects (business_class, dl_id, sha256, archived_at) VALUES (?, ?, ?, ?)',
+                (business_class, dl_id, sha256, now)
+            )
+            if previous and previous[0] != sha256:
+                self._release(previous[0])
+
+        if self.max_bytes:
+            self.evict()
+        return sha256
+
+    def get(self, business_class: str, dl_id: str) -> bytes:
+        """
+        Returns the archived body of a data object. Raises KeyError if the object is
+        not archived and ValueError if its body does not match its hash; the corrupt
+        body is removed so the next `put` of that content writes it again.
+        """
+        with self._lock:
+            row = self._conn.execute(
+                '''SELECT b.sha256, b.filename FROM objects o JOIN blobs b ON b.sha256 = o.sha256
+                   WHERE o.business_class = ? AND o.dl_id = ?''',
+                (business_class, dl_id)
+            ).fetchone()
+        if row is None:
+            raise KeyError(f'Data object {dl_id} of {business_class} is not archived')
+
+        sha256, filename = row
+        try:
+            with compression.open_compressed(self._path(filename), 'rb') as f:
+                body = f.read()
+        except FileNotFoundError:
+            raise KeyError(f'Archived body of data object {dl_id} of {business_class} is missing')
+        if hashlib.sha256(body).hexdigest() != sha256:
+            self._remove(filename)
+            raise ValueError(f'Archived body of data object {dl_id} of {business_class} is corrupt')
+
+        with self._lock, self._conn:
+            self._conn.execute('UPDATE blobs SET last_used = ? WHERE sha256 = ?', (time.time(), sha256))
+        return body
+
+    def ids(self, business_class: str) -> List[str]:
+        """
+        Returns the ids of the archived data objects of a business class in the order
+        they were archived.
+        """
+        with self._lock:
+            return [dl_id for (dl_id,) in self._conn.execute(
+                'SELECT dl_id FROM objects WHERE business_class = ? ORDER BY archived_at, rowid',
+                (business_class,)
+            )]
+
+    def size(self) -> int:
+        """
+        Returns the number of bytes the archived bodies take on disk.
+        """
+        with self._lock:
+            return self._conn.execute('SELECT bytes FROM totals WHERE id = 0').fetchone()[0]
+
+    def _release(self, sha256: str):
+        """
+        Removes a body no data object maps to any more. Called inside a transaction.
+        """
+        if self._conn.execute('SELECT 1 FROM objects WHERE sha256 = ? LIMIT 1', (sha256,)).fetchone():
+            return
+        row = self._conn.execute('SELECT filename, size FROM blobs WHERE sha256 = ?', (sha256,)).fetchone()
+        if row:
+            self._conn.execute('DELETE FROM blobs WHERE sha256 = ?', (sha256,))
+            self._add_bytes(-row[1])
+            self._remove(row[0])
+
+    def _remove(self, filename: str):
+        try:
+            os.remove(self._path(filename))
+        except FileNotFoundError:
+            pass
+
+    def evict(self, max_bytes: int = None) -> int:
+        """
+        Removes the least recently used bodies, and the data objects that map to them,
+        until the archive takes at most `max_bytes` (the archive's limit by default).
+        Returns the number of bodies removed.
+        """
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        removed = 0
+        with self._lock, self._conn:
+            total = self._conn.execute('SELECT bytes FROM totals WHERE id = 0').fetchone()[0]
+            while total > max_bytes:
+                # Oldest bodies first, a few at a time, using the last_used index.
+                oldest = self._conn.execute(
+                    'SELECT sha256, filename, size FROM blobs ORDER BY last_used LIMIT 64'
+                ).fetchall()
+                if not oldest:
+                    break
+
+                for sha256, filename, size in oldest:
+                    if total <= max_bytes:
+                        break
+                    self._conn.execute('DELETE FROM objects WHERE sha256 = ?', (sha256,))
+                    self._conn.execute('DELETE FROM blobs WHERE sha256 = ?', (sha256,))
+                    self._add_bytes(-size)
+                    self._remove(filename)
+                    total -= size
+                    removed += 1
+
+        return removed
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,75 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from itertools import accumulate, repeat
+from operator import and_, xor
+from typing import Dict, List
+from utilities import compression, parquetio
+
+"""
+Counts the records in business class data files. Files are read in large binary
+chunks, newlines are counted with `bytes.count`, and several files are counted at
+once in a process pool. Newlines inside quoted values are not counted, so records
+with multi-line values count once.
+"""
+
+CHUNK_SIZE = 16 * 1024 * 1024
+
+def count_newlines(chunk: bytes, in_quotes: bool, quoted: bool = True) -> tuple:
+    """
+    Returns the number of record-ending newlines in a chunk and whether the chunk
+    ends inside a quoted value.
+
+    chunk     -- bytes to count
+    in_quotes -- True if the chunk starts inside a quoted value
+    quoted    -- False to count every newline
+    """
+    if not quoted:
+        return chunk.count(b'\n'), False
+    if b'"' not in chunk:
+        return (0 if in_quotes else chunk.count(b'\n')), in_quotes
+
+    # Quote parity at the end of each line, counted in C; a newline ends a record
+    # when the number of quotes before it is even.
+    lines = chunk.split(b'\n')
+    parities = list(accumulate(map(and_, map(bytes.count, lines, repeat(b'"')), repeat(1)), xor, initial=int(in_quotes)))
+    return parities[1:-1].count(0), bool(parities[-1])
+
+def count_records(filename: str, quoted: bool = True) -> int:
+    """
+    Returns the number of records in a csv data file, compressed or not, or in
+    the parquet files of a csv filename. A last line without a newline counts as a record.
+
+    filename -- data file to count
+    quoted   -- True if values may be quoted and contain newlines (RFC 4180)
+    """
+    if filename.endswith('.parquet') or not os.path.exists(filename) and parquetio.parquet_parts(filename):
+        parquetio.require_pyarrow()
+        return sum(parquetio.pq.ParquetFile(part).metadata.num_rows for part in parquetio.parquet_parts(filename))
+
+    count, in_quotes, last = 0, False, b'\n'
+    with compression.open_compressed(filename, 'rb') as f:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            n, in_quotes = count_newlines(chunk, in_quotes, quoted)
+            count += n
+            last = chunk[-1:]
+
+    return count + (last != b'\n')
+
+def count_files(filenames: List[str], workers: int = None, quoted: bool = True) -> Dict[str, int]:
+    """
+    Returns the number of records in each file, counting up to `workers` files
+    at once in separate processes.
+
+    filenames -- data files to count
+    workers   -- number of processes; one per CPU by default
+    quoted    -- True if values may be quoted and contain newlines (RFC 4180)
+    """
+    workers = min(workers or os.cpu_count() or 1, len(filenames))
+    if workers <= 1:
+        return {filename: count_records(filename, quoted) for filename in filenames}
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return dict(zip(filenames, executor.map(count_records, filenames, repeat(quoted))))
@@ -0,0 +1,128 @@
+import datetime
+import json
+import os
+import definitions as defs
+from typing import Dict, NamedTuple
+from config.config import get_config
+
+"""
+Values that stay the same for the whole of an extraction run, read and resolved
+once instead of on every call: the table config of each business class, the
+active incremental id and the filename templates resolved for each business class.
+"""
+
+class _Placeholders(dict):
+    """
+    Keeps the placeholders of a template that are not resolved yet (e.g. `{version}`).
+    """
+    def __missing__(self, key: str) -> str:
+        return f'{{{key}}}'
+
+def resolve_template(template: str, business_class: str, active_inc_id: int) -> str:
+    return template.format_map(_Placeholders(
+        business_class=business_class,
+        bc_folder=business_class,
+        bc_file=business_class,
+        bc_name=business_class,
+        active_inc_id=active_inc_id
+    ))
+
+def resolve_templates(templates: Dict[str, str], business_class: str, active_inc_id: int) -> Dict[str, str]:
+    return {option: resolve_template(template, business_class, active_inc_id) for option, template in templates.items()}
+
+def compute_active_inc_id(config=None, cutoff_hour: int = None) -> int:
+    """
+    Returns the id of the active incremental extraction: 05:00 of the current day
+    in mountain time, or of the previous day before `cutoff_hour`, as a timestamp.
+    The `active_inc_id_override` config value is used instead if set.
+    """
+    config = config or get_config()
+    if config.get('inc_extraction', 'active_inc_id_override'):
+        return config.getint('inc_extraction', 'active_inc_id_override')
+
+    if not cutoff_hour:
+        cutoff_hour = int(config.get('inc_extraction', 'cutoff_hour'))
+
+    curr = datetime.datetime.now().timestamp()
+    mountain_time = curr - 21600 # Go back 6 hours to get to mountain time
+    curr = datetime.datetime.fromtimestamp(mountain_time)
+
+    y,m,d,h = (curr.year,
+            curr.month,
+            curr.day,
+            curr.hour)
+
+    return int((datetime.datetime(y,m,d,5,0,0).timestamp()) - (86400 if h < (cutoff_hour) else 0))
+
+class RunContext(NamedTuple):
+    """
+    Immutable values of an extraction run. Built once per run with `build` and
+    passed to worker processes so every process uses the same incremental id.
+
+    active_inc_id      -- id of the active incremental extraction, frozen when the run starts
+    table_config       -- entry of each business class in the `bc_table_config_map` file, by business class
+    filename_templates -- the filename_templates section of the config file
+    filenames          -- filename templates resolved for each business class in the table config
+    """
+    active_inc_id: int
+    table_config: Dict[str, dict]
+    filename_templates: Dict[str, str]
+    filenames: Dict[str, Dict[str, str]]
+
+    @classmethod
+    def build(cls, config=None) -> 'RunContext':
+        config = config or get_config()
+        with open(os.path.join(defs.ROOT_DIR, config.get('filename_templates', 'bc_table_config_map')), 'r') as f:
+            table_config = {v['business_class_name']: v for v in json.load(f).values()}
+
+        active_inc_id = compute_active_inc_id(config)
+        templates = dict(config.items('filename_templates'))
+
+        return cls(
+            active_inc_id=active_inc_id,
+            table_config=table_config,
+            filename_templates=templates,
+            filenames={bc: resolve_templates(templates, bc, active_inc_id) for bc in table_config}
+        )
+
+    def is_incremental(self, business_class: str) -> bool:
+        entry = self.table_config.get(business_class)
+        return entry['incremental'] if entry else None
+
+    def is_watermarked(self, business_class: str) -> bool:
+        entry = self.table_config.get(business_class)
+        return entry.get('watermark', False) if entry else False
+
+    def staging_table_name(self, business_class: str) -> str:
+        entry = self.table_config.get(business_class)
+        return entry['staging_table_name'] if entry else None
+
+    def filename(self, business_class: str, option: str) -> str:
+        """
+        Returns a filename template of the filename_templates section resolved for
+        a business class and the active incremental id. Placeholders that vary
+        within a run, like `{version}`, are left in place.
+        """
+        resolved = self.filenames.get(business_class)
+        if resolved is None:
+            return resolve_template(self.filename_templates[option], business_class, self.active_inc_id)
+        return resolved[option]
+
+_current = None
+
+def run_context() -> RunContext:
+    """
+    Returns the context of the current run, building it on first use.
+    """
+    global _current
+    if _current is None:
+        _current = RunContext.build()
+    return _current
+
+def set_run_context(context: RunContext):
+    """
+    Makes `context` the context of the current run, e.g. in a worker process.
+    None clears it so the next call to `run_context` builds a new one.
+    """
+    global _current
+    _current = context
@@ -0,0 +1,67 @@
+import time
+from typing import Dict, Iterable, List
+
+"""
+Orders the data objects of a business class for extraction and estimates how
+long the rest of the extraction will take, using the record count the datalake
+lists for every object (`dl_instance_count`).
+"""
+
+LARGEST_FIRST = 'largest_first'
+LISTING = 'listing'
+
+def schedule(ids: Iterable[str], sizes: Dict[str, int], order: str = LARGEST_FIRST) -> List[str]:
+    """
+    Returns the ids in the order they should be extracted. Largest first starts the
+    biggest objects while there are still small ones left to keep the other workers
+    busy, so no single large object is left running alone at the end. Ties and ids
+    without a size keep their listing order.
+
+    ids   -- ids of the data objects to extract
+    sizes -- record count of each data object by id
+    order -- `largest_first` or `listing`
+    """
+    ids = list(ids)
+    if order == LISTING or not sizes:
+        return ids
+    if order != LARGEST_FIRST:
+        raise ValueError(f'Unknown extraction order: {order}')
+
+    return sorted(ids, key=lambda id: sizes.get(id, 0), reverse=True)
+
+def format_duration(seconds: float) -> str:
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f'{hours}h{minutes:02d}m' if hours else f'{minutes}m{seconds:02d}s'
+
+class ExtractionProgress:
+    """
+    Tracks the records extracted so far and projects the time left from the rate
+    at which records have been extracted.
+
+    ids   -- ids of the data objects being extracted
+    sizes -- record count of each data object by id
+    """
+    def __init__(self, ids: Iterable[str], sizes: Dict[str, int]):
+        self.sizes = sizes
+        self.total = sum(sizes.get(id, 0) for id in ids)
+        self.done = 0
+        self.started = time.monotonic()
+
+    def update(self, id: str):
+        self.done += self.sizes.get(id, 0)
+
+    @property
+    def remaining_seconds(self) -> float:
+        """
+        Projected seconds left, or None until a record has been extracted.
+        """
+        if not self.done:
+            return None
+        elapsed = time.monotonic() - self.started
+        return (self.total - self.done) * elapsed / self.done
+
+    def __str__(self):
+        remaining = self.remaining_seconds
+        eta = f', about {format_duration(remaining)} left' if remaining is not None else ''
+        return f'{self.done:,} / {self.total:,} records{eta}'
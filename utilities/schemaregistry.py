@@ -0,0 +1,90 @@
+from operator import itemgetter
+from typing import Callable, Dict, List
+
+"""
+Keeps track of the schema versions of a business class while its data is
+being extracted from the datalake.
+"""
+
+def column_getter(columns: List[str]) -> Callable[[dict], tuple]:
+    """
+    Returns a function that takes a record and returns its values as a tuple
+    in the order of the given columns.
+    """
+    if not columns:
+        return lambda record: ()
+
+    if len(columns) == 1:
+        column = columns[0]
+        return lambda record: (record[column],)
+
+    return itemgetter(*columns)
+
+class SchemaRegistry:
+    """
+    Maps the keys of a datalake record to the schema version they belong to.
+    Versions are indexed by a frozenset fingerprint of their columns, so lookups
+    and allocating the next version number take constant time no matter how
+    many versions exist.
+
+    The registry wraps the `{version: [columns]}` dict returned by `get_schemas`
+    and adds new versions to it in place, so the same dict can be written back
+    to the `{business_class}_schemas.json` file.
+
+    Versions always cover every column of a record, but only the columns kept by
+    `project` are returned by `values`.
+
+    schemas -- schema versions of the business class
+    project -- function returning the columns of a schema to extract; all if None
+    """
+    def __init__(self, schemas: Dict[str, List[str]], project: Callable[[List[str]], List[str]] = None):
+        self.schemas = schemas
+        self.project = project
+        self._versions = {}
+        self._getters = {}
+        self._next_version = 0
+
+        for version, columns in schemas.items():
+            self._register(version, columns)
+
+    def _register(self, version: str, columns: List[str]):
+        # The first version registered for a set of columns wins, as list.index did.
+        self._versions.setdefault(frozenset(columns), version)
+        self._getters[version] = column_getter(self.project(columns) if self.project else columns)
+        self._next_version = max(self._next_version, int(version) + 1)
+
+    def version(self, record: dict) -> str:
+        """
+        Returns the schema version of a record, registering a new version using
+        the record's key order if its set of keys has not been seen before.
+        """
+        version = self._versions.get(frozenset(record))
+        if version is None:
+            version = f'{self._next_version}'
+            self.schemas[version] = list(record)
+            self._register(version, self.schemas[version])
+
+        return version
+
+    def columns(self, version: str) -> List[str]:
+        return self.schemas[version]
+
+    def extracted_columns(self, version: str) -> List[str]:
+        """
+        Returns the columns of a schema version whose values are extracted.
+        """
+        columns = self.schemas[version]
+        return self.project(columns) if self.project else list(columns)
+
+    def values(self, version: str, record: dict) -> tuple:
+        """
+        Returns the values of the extracted columns of a record in the column order
+        of its schema version, regardless of the order of the keys in the record itself.
+        """
+        return self._getters[version](record)
+
+    def __contains__(self, version: str) -> bool:
+        return version in self.schemas
+
+    def __len__(self) -> int:
+        return len(self.schemas)
@@ -0,0 +1,139 @@
+import logging
+import threading
+from typing import Callable, Iterable
+from utilities.compression import open_compressed
+
+"""
+Buffered writers for the files that hold business class data by schema version.
+"""
+
+WRITE_BUFFER_SIZE = 1024 * 1024
+FLUSH_THRESHOLD = 8 * 1024 * 1024
+
+class SchemaWriterPool:
+    """
+    Keeps one large-buffered append handle open per (business class, schema version)
+    for the length of an extraction instead of reopening the file for every data
+    object. Handles are flushed once `flush_threshold` characters have been written
+    to them and are flushed and closed when the pool is closed, including when the
+    extraction fails. Writes are serialised with a lock so the pool can be fed from
+    several threads.
+
+    `begin`, `commit` and `rollback` remove the rows of a data object that failed
+    part way through being written, so it can be extracted again without
+    duplicating rows. Only the files written to inside a transaction are marked,
+    when they are first written to, so files are not flushed for every object.
+
+    Files with a `.gz` or `.zst` extension are compressed as they are written.
+
+    filename            -- function taking (business_class, version) and returning the file to append to
+    buffer_size         -- size of the buffer of each open file
+    flush_threshold     -- number of characters written to a file before it is flushed
+    compression_options -- level and threads of compressed files, passed to `open_compressed`
+    """
+    def __init__(self, filename: Callable[[str, str], str], buffer_size: int = WRITE_BUFFER_SIZE,
+                 flush_threshold: int = FLUSH_THRESHOLD, compression_options: dict = None):
+        self.filename = filename
+        self.buffer_size = buffer_size
+        self.flush_threshold = flush_threshold
+        self.compression_options = compression_options or {}
+        self._files = {}
+        self._unflushed = {}
+        self._marks = None
+        self._counts_mark = None
+        self._lock = threading.Lock()
+        self.chars_written = 0
+        self.rows_written = 0
+
+    def _open(self, key: tuple):
+        f = open_compressed(self.filename(*key), 'a', buffering=self.buffer_size, **self.compression_options)
+        self._files[key] = f
+        self._unflushed[key] = 0
+        return f
+
+    def write(self, business_class: str, version: str, rows: Iterable[str]) -> int:
+        """
+        Appends rows to the file of a business class schema version. Returns the
+        number of rows written.
+        """
+        key = (business_class, version)
+        count = 0
+        with self._lock:
+            f = self._files.get(key) or self._open(key)
+            if self._marks is not None and key not in self._marks:
+                self._marks[key] = f.tell()
+            for row in rows:
+                f.write(row)
+                self._unflushed[key] += len(row)
+                self.chars_written += len(row)
+                count += 1
+            self.rows_written += count
+
+            if self._unflushed[key] >= self.flush_threshold:
+                f.flush()
+                self._unflushed[key] = 0
+
+        return count
+
+    def begin(self):
+        """
+        Starts a transaction: the rows written after this call can be removed by
+        `rollback`. Each file is marked where it ends when it is first written to.
+        """
+        with self._lock:
+            self._marks = {}
+            self._counts_mark = (self.rows_written, self.chars_written)
+
+    def commit(self):
+        with self._lock:
+            self._marks = None
+            self._counts_mark = None
+
+    def rollback(self):
+        """
+        Truncates the files written to since `begin` back to where they ended, and
+        takes their rows out of the counts.
+        """
+        with self._lock:
+            for key, position in (self._marks or {}).items():
+                self._files[key].truncate(position)
+                self._unflushed[key] = 0
+            if self._counts_mark:
+                self.rows_written, self.chars_written = self._counts_mark
+            self._marks = None
+            self._counts_mark = None
+
+    def flush(self):
+        with self._lock:
+            for key, f in self._files.items():
+                f.flush()
+                self._unflushed[key] = 0
+
+    def offsets(self) -> dict:
+        """
+        Flushes every open file and returns the byte position it ends at, by
+        filename. Compressed files end at a block boundary.
+        """
+        with self._lock:
+            offsets = {}
+            for key, f in self._files.items():
+                f.flush()
+                self._unflushed[key] = 0
+                offsets[self.filename(*key)] = f.buffer.tell()
+            return offsets
+
+    def close(self):
+        with self._lock:
+            for key, f in self._files.items():
+                try:
+                    f.close()
+                except Exception as e:
+                    logging.error(f'Error closing {self.filename(*key)}: {e}')
+            self._files.clear()
+            self._unflushed.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,520 @@
+import logging
+import os
+import sqlite3
+import threading
+from datetime import datetime
+from typing import Dict, Iterable, List
+
+"""
+Local, indexed record of which datalake objects have been extracted for each
+business class. Replaces diffing the flat extraction history files in memory
+and keeps progress on disk while a business class is being extracted.
+"""
+
+PENDING = 'pending'
+DONE = 'done'
+FAILED = 'failed'
+
+class ExtractionStateStore:
+    """
+    SQLite store (WAL mode) holding the status of every data object of a business
+    class: pending, done or failed, along with the time it was extracted and the
+    schema versions its records were written to. Status updates are queued until
+    `flush` is called; `batch_size` is how many the caller should queue before
+    flushing, after the rows of those objects have been flushed to disk.
+
+    Objects that fail are also kept in a failure queue with the number of attempts
+    and the last error, until they are extracted. Objects extracted with a different
+    number of records than the datalake lists are done, and recorded as mismatches.
+
+    The flat extraction history files stay the format exchanged with S3. They are
+    imported when they change and exported from the store after each extraction.
+
+    `checkpoint` commits the status updates together with the position the data
+    files end at, so a resumed extraction can truncate the files back to the rows
+    of the objects recorded as done.
+
+    filename   -- path of the SQLite database
+    batch_size -- number of status updates to queue before committing
+    """
+    def __init__(self, filename: str, batch_size: int = 500):
+        if os.path.dirname(filename):
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+
+        self.filename = filename
+        self.batch_size = batch_size
+        self._queued = []
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(filename, timeout=60, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._create_tables()
+
+    def _create_tables(self):
+        with self._lock, self._conn:
+            self._conn.executescript('''
+                CREATE TABLE IF NOT EXISTS object_state (
+                    business_class TEXT NOT NULL,
+                    dl_id          TEXT NOT NULL,
+                    status         TEXT NOT NULL,
+                    extracted_at   TEXT,
+                    schema_version TEXT,
+                    run_id         TEXT,
+                    PRIMARY KEY (business_class, dl_id)
+                ) WITHOUT ROWID;
+
+                CREATE INDEX IF NOT EXISTS object_state_status
+                    ON object_state (business_class, status);
+
+                CREATE TABLE IF NOT EXISTS runs (
+                    business_class TEXT NOT NULL,
+                    run_id         TEXT NOT NULL,
+                    started_at     TEXT NOT NULL,
+                    finished_at    TEXT,
+                    PRIMARY KEY (business_class, run_id)
+                );
+
+                CREATE TABLE IF NOT EXISTS watermarks (
+                    business_class TEXT PRIMARY KEY,
+                    dl_timestamp   TEXT NOT NULL,
+                    updated_at     TEXT NOT NULL
+                );
+
+                CREATE TABLE IF NOT EXISTS failures (
+                    business_class TEXT NOT NULL,
+                    dl_id          TEXT NOT NULL,
+                    attempts       INTEGER NOT NULL,
+                    last_error     TEXT,
+                    failed_at      TEXT NOT NULL,
+                    PRIMARY KEY (business_class, dl_id)
+                ) WITHOUT ROWID;
+
+                CREATE TABLE IF NOT EXISTS count_mismatches (
+                    business_class TEXT NOT NULL,
+                    dl_id          TEXT NOT NULL,
+                    expected       INTEGER NOT NULL,
+                    written        INTEGER NOT NULL,
+                    run_id         TEXT,
+                    recorded_at    TEXT NOT NULL,
+                    PRIMARY KEY (business_class, dl_id)
+                ) WITHOUT ROWID;
+
+                CREATE TABLE IF NOT EXISTS run_stats (
+                    business_class TEXT NOT NULL,
+                    run_id         TEXT,
+                    finished_at    TEXT NOT NULL,
+                    objects        INTEGER NOT NULL,
+                    records        INTEGER NOT NULL,
+                    bytes          INTEGER NOT NULL,
+                    seconds        REAL NOT NULL
+                );
+
+                CREATE INDEX IF NOT EXISTS run_stats_business_class
+                    ON run_stats (business_class, finished_at);
+
+                CREATE TABLE IF NOT EXISTS file_offsets (
+                    business_class TEXT NOT NULL,
+                    run_id         TEXT NOT NULL,
+                    filename       TEXT NOT NULL,
+                    position       INTEGER NOT NULL,
+                    PRIMARY KEY (business_class, run_id, filename)
+                ) WITHOUT ROWID;
+
+                CREATE TABLE IF NOT EXISTS history_imports (
+                    business_class TEXT NOT NULL,
+                    filename       TEXT NOT NULL,
+                    mtime          REAL NOT NULL,
+                    size           INTEGER NOT NULL,
+                    PRIMARY KEY (business_class, filename)
+                );
+            ''')
+
+    def start_run(self, business_class: str, run_id: str, offsets: Dict[str, int] = None) -> bool:
+        """
+        Records the start of an extraction. Returns True if the previous extraction
+        with the same run id did not finish, meaning this one resumes it.
+
+        offsets -- size of each existing data file, by filename; recorded as the
+                   checkpoint of a new extraction so that resuming it never cuts
+                   rows written before it started
+        """
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                'SELECT finished_at FROM runs WHERE business_class = ? AND run_id = ?',
+                (business_class, run_id)
+            ).fetchone()
+            self._conn.execute(
+                'INSERT OR REPLACE INTO runs (business_class, run_id, started_at, finished_at) VALUES (?, ?, ?, NULL)',
+                (business_class, run_id, datetime.now().isoformat())
+            )
+            resuming = row is not None and row[0] is None
+            if not resuming:
+                self._conn.execute('DELETE FROM file_offsets WHERE business_class = ? AND run_id = ?', (business_class, run_id))
+                self._conn.executemany(
+                    'INSERT INTO file_offsets (business_class, run_id, filename, position) VALUES (?, ?, ?, ?)',
+                    ((business_class, run_id, filename, position) for filename, position in (offsets or {}).items())
+                )
+
+        return resuming
+
+    def last_run(self, business_class: str, prefix: str = '') -> tuple:
+        """
+        Returns (run_id, finished_at) of the latest extraction of a business class
+        whose run id starts with `prefix`, or None. finished_at is None while the
+        extraction has not finished.
+        """
+        with self._lock:
+            return self._conn.execute(
+                '''SELECT run_id, finished_at FROM runs WHERE business_class = ? AND substr(run_id, 1, ?) = ?
+                   ORDER BY started_at DESC LIMIT 1''',
+                (business_class, len(prefix), prefix)
+            ).fetchone()
+
+    def finish_run(self, business_class: str, run_id: str):
+        self.flush()
+        with self._lock, self._conn:
+            self._conn.execute(
+                'UPDATE runs SET finished_at = ? WHERE business_class = ? AND run_id = ?',
+                (datetime.now().isoformat(), business_class, run_id)
+            )
+
+    def watermark(self, business_class: str) -> str:
+        """
+        Returns the newest object timestamp recorded for a business class, or None.
+        """
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT dl_timestamp FROM watermarks WHERE business_class = ?', (business_class,)
+            ).fetchone()
+
+        return row[0] if row else None
+
+    def set_watermark(self, business_class: str, dl_timestamp):
+        with self._lock, self._conn:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO watermarks (business_class, dl_timestamp, updated_at) VALUES (?, ?, ?)',
+                (business_class, str(dl_timestamp), datetime.now().isoformat())
+            )
+
+    def import_history(self, business_class: str, filename: str) -> int:
+        """
+        Makes the done ids of a business class match an extraction history file: the
+        ids in the file are marked done and done ids missing from it are pending
+        again, except those done by an extraction that has not finished, whose rows
+        are in its data files. The file is skipped if it has not changed since it was
+        last imported or exported. Returns the number of ids read from the file.
+        """
+        if not self.history_changed(business_class, filename):
+            return 0
+
+        with self._lock:
+            with open(filename, 'r') as f:
+                ids = [line.strip() for line in f if line.strip()]
+
+            with self._conn:
+                self._conn.executemany(
+                    '''INSERT INTO object_state (business_class, dl_id, status) VALUES (?, ?, ?)
+                       ON CONFLICT (business_class, dl_id) DO UPDATE SET status = excluded.status''',
+                    ((business_class, dl_id, DONE) for dl_id in ids)
+                )
+                self._conn.execute('CREATE TEMP TABLE IF NOT EXISTS history_ids (dl_id TEXT PRIMARY KEY)')
+                self._conn.execute('DELETE FROM history_ids')
+                self._conn.executemany('INSERT OR IGNORE INTO history_ids (dl_id) VALUES (?)', ((dl_id,) for dl_id in ids))
+                reset = self._conn.execute(
+                    '''UPDATE object_state SET status = ?
+                       WHERE business_class = ? AND status = ?
+                         AND dl_id NOT IN (SELECT dl_id FROM history_ids)
+                         AND (run_id IS NULL OR run_id NOT IN (
+                             SELECT run_id FROM runs WHERE business_class = ? AND finished_at IS NULL
+                         ))''',
+                    (PENDING, business_class, DONE, business_class)
+                ).rowcount
+                self._conn.execute('DELETE FROM history_ids')
+                self._record_history_file(business_class, filename)
+
+        logging.info(f'Imported {len(ids)} extracted ids for {business_class} from {filename}')
+        if reset:
+            logging.info(f'{reset} ids of {business_class} missing from {filename} will be extracted again')
+        return len(ids)
+
+    def history_changed(self, business_class: str, filename: str) -> bool:
+        """
+        Returns True if an extraction history file exists and has changed since it
+        was last imported or exported.
+        """
+        if not os.path.exists(filename):
+            return False
+
+        stat = os.stat(filename)
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT mtime, size FROM history_imports WHERE business_class = ? AND filename = ?',
+                (business_class, filename)
+            ).fetchone()
+
+        return row != (stat.st_mtime, stat.st_size)
+
+    def planned_not_extracted(self, business_class: str, ids: Iterable[str], filename: str) -> List[str]:
+        """
+        Returns the ids `not_extracted` would return once the extraction history file
+        has been imported, without changing the store. Used by dry runs.
+        """
+        if not self.history_changed(business_class, filename):
+            return self.not_extracted(business_class, ids, add_pending=False)
+
+        with open(filename, 'r') as f:
+            history = {line.strip() for line in f if line.strip()}
+
+        # Ids done by an unfinished extraction stay done when the file is imported.
+        with self._lock:
+            unfinished = {dl_id for (dl_id,) in self._conn.execute(
+                '''SELECT dl_id FROM object_state
+                   WHERE business_class = ? AND status = ? AND run_id IN (
+                       SELECT run_id FROM runs WHERE business_class = ? AND finished_at IS NULL
+                   )''',
+                (business_class, DONE, business_class)
+            )}
+
+        return [dl_id for dl_id in ids if dl_id not in history and dl_id not in unfinished]
+
+    def export_history(self, business_class: str, filename: str) -> int:
+        """
+        Writes every done id of a business class to an extraction history file, one
+        id per line. Returns the number of ids written.
+        """
+        self.flush()
+        count = 0
+        with self._lock:
+            with open(filename, 'w') as f:
+                for (dl_id,) in self._conn.execute(
+                    'SELECT dl_id FROM object_state WHERE business_class = ? AND status = ?',
+                    (business_class, DONE)
+                ):
+                    f.write(f'{dl_id}\n')
+                    count += 1
+
+            with self._conn:
+                self._record_history_file(business_class, filename)
+
+        return count
+
+    def _record_history_file(self, business_class: str, filename: str):
+        stat = os.stat(filename)
+        self._conn.execute(
+            'INSERT OR REPLACE INTO history_imports (business_class, filename, mtime, size) VALUES (?, ?, ?, ?)',
+            (business_class, filename, stat.st_mtime, stat.st_size)
+        )
+
+    def not_extracted(self, business_class: str, ids: Iterable[str], add_pending: bool = True) -> List[str]:
+        """
+        Returns the ids that are not done, in the order they were given, using an
+        indexed anti-join against the store. Ids not seen before are added as pending
+        unless `add_pending` is False.
+        """
+        self.flush()
+        with self._lock, self._conn:
+            self._conn.execute('CREATE TEMP TABLE IF NOT EXISTS listed_ids (dl_id TEXT NOT NULL)')
+            self._conn.execute('DELETE FROM listed_ids')
+            self._conn.executemany('INSERT INTO listed_ids (dl_id) VALUES (?)', ((dl_id,) for dl_id in ids))
+            if add_pending:
+                self._conn.execute(
+                    '''INSERT OR IGNORE INTO object_state (business_class, dl_id, status)
+                       SELECT ?, dl_id, ? FROM listed_ids''',
+                    (business_class, PENDING)
+                )
+            not_done = [dl_id for (dl_id,) in self._conn.execute(
+                '''SELECT l.dl_id FROM listed_ids l
+                   LEFT JOIN object_state s ON s.business_class = ? AND s.dl_id = l.dl_id AND s.status = ?
+                   WHERE s.dl_id IS NULL
+                   ORDER BY l.rowid''',
+                (business_class, DONE)
+            )]
+            self._conn.execute('DELETE FROM listed_ids')
+
+        return not_done
+
+    @property
+    def batch_full(self) -> bool:
+        return len(self._queued) >= self.batch_size
+
+    def mark(self, business_class: str, dl_id: str, status: str, schema_version: str = None, run_id: str = None,
+             error: str = None):
+        """
+        Queues a status update for a data object. Updates are committed when
+        `flush` is called. Failed objects are added to the failure queue with
+        `error`; done objects are removed from it.
+        """
+        with self._lock:
+            self._queued.append((business_class, dl_id, status, datetime.now().isoformat(), schema_version, run_id, error))
+
+    def flush(self):
+        with self._lock:
+            if not self._queued:
+                return
+
+            with self._conn:
+                self._commit_queued()
+
+    def checkpoint(self, business_class: str, run_id: str, offsets: Dict[str, int]):
+        """
+        Commits the queued status updates and the position each data file of a run
+        ends at in one transaction. Called once the rows of the queued objects have
+        been flushed to the data files.
+
+        offsets -- byte position of the end of each data file, by filename
+        """
+        with self._lock, self._conn:
+            self._commit_queued()
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO file_offsets (business_class, run_id, filename, position) VALUES (?, ?, ?, ?)',
+                ((business_class, run_id, filename, position) for filename, position in offsets.items())
+            )
+
+    def offsets(self, business_class: str, run_id: str) -> Dict[str, int]:
+        """
+        Returns the position each data file of a run ended at when it was last
+        checkpointed, by filename.
+        """
+        with self._lock:
+            return dict(self._conn.execute(
+                'SELECT filename, position FROM file_offsets WHERE business_class = ? AND run_id = ?',
+                (business_class, run_id)
+            ))
+
+    def _commit_queued(self):
+        if self._queued:
+            self._conn.executemany(
+                '''INSERT INTO object_state (business_class, dl_id, status, extracted_at, schema_version, run_id)
+                   VALUES (?, ?, ?, ?, ?, ?)
+                   ON CONFLICT (business_class, dl_id) DO UPDATE SET
+                       status = excluded.status,
+                       extracted_at = excluded.extracted_at,
+                       schema_version = excluded.schema_version,
+                       run_id = excluded.run_id''',
+                (update[:6] for update in self._queued)
+            )
+            self._conn.executemany(
+                '''INSERT INTO failures (business_class, dl_id, attempts, last_error, failed_at)
+                   VALUES (?, ?, 1, ?, ?)
+                   ON CONFLICT (business_class, dl_id) DO UPDATE SET
+                       attempts = attempts + 1,
+                       last_error = excluded.last_error,
+                       failed_at = excluded.failed_at''',
+                ((bc, dl_id, error, at) for bc, dl_id, status, at, _, _, error in self._queued if status == FAILED)
+            )
+            self._conn.executemany(
+                'DELETE FROM failures WHERE business_class = ? AND dl_id = ?',
+                ((bc, dl_id) for bc, dl_id, status, *_ in self._queued if status == DONE)
+            )
+            self._queued = []
+
+    def ids(self, business_class: str, status: str, run_id: str = None) -> List[str]:
+        """
+        Returns the ids of a business class with a status, only those of one run if
+        `run_id` is given.
+        """
+        self.flush()
+        where, params = ('AND run_id = ?', (business_class, status, run_id)) if run_id is not None else ('', (business_class, status))
+        with self._lock:
+            return [dl_id for (dl_id,) in self._conn.execute(
+                f'SELECT dl_id FROM object_state WHERE business_class = ? AND status = ? {where}',
+                params
+            )]
+
+    def record_run_stats(self, business_class: str, run_id: str, objects: int, records: int, bytes: int, seconds: float):
+        """
+        Records how much an extraction of a business class wrote and how long it took.
+        """
+        with self._lock, self._conn:
+            self._conn.execute(
+                '''INSERT INTO run_stats (business_class, run_id, finished_at, objects, records, bytes, seconds)
+                   VALUES (?, ?, ?, ?, ?, ?, ?)''',
+                (business_class, run_id, datetime.now().isoformat(), objects, records, bytes, seconds)
+            )
+
+    def throughput(self, business_class: str = None, runs: int = 10) -> tuple:
+        """
+        Returns (records per second, bytes per record) over the last `runs` recorded
+        extractions of a business class, or of every business class if none is given.
+        Returns None if nothing has been recorded.
+        """
+        where, params = ('WHERE business_class = ?', (business_class, runs)) if business_class else ('', (runs,))
+        with self._lock:
+            records, bytes, seconds = self._conn.execute(
+                f'''SELECT SUM(records), SUM(bytes), SUM(seconds) FROM (
+                       SELECT records, bytes, seconds FROM run_stats {where}
+                       ORDER BY finished_at DESC LIMIT ?
+                   )''',
+                params
+            ).fetchone()
+
+        if not records or not seconds:
+            return None
+        return records / seconds, bytes / records
+
+    def failures(self, business_class: str) -> List[tuple]:
+        """
+        Returns the failure queue of a business class as (dl_id, attempts, last_error)
+        tuples, oldest failure first. Objects done since they failed are left out.
+        """
+        self.flush()
+        with self._lock:
+            return self._conn.execute(
+                '''SELECT f.dl_id, f.attempts, f.last_error FROM failures f
+                   JOIN object_state s ON s.business_class = f.business_class AND s.dl_id = f.dl_id
+                   WHERE f.business_class = ? AND s.status = ?
+                   ORDER BY f.failed_at''',
+                (business_class, FAILED)
+            ).fetchall()
+
+    def record_mismatch(self, business_class: str, dl_id: str, expected: int, written: int, run_id: str = None):
+        """
+        Records that a data object was extracted with `written` records while the
+        datalake lists `expected`. The object is still marked done by the caller.
+        """
+        with self._lock, self._conn:
+            self._conn.execute(
+                '''INSERT OR REPLACE INTO count_mismatches (business_class, dl_id, expected, written, run_id, recorded_at)
+                   VALUES (?, ?, ?, ?, ?, ?)''',
+                (business_class, dl_id, expected, written, run_id, datetime.now().isoformat())
+            )
+
+    def clear_mismatch(self, business_class: str, dl_id: str):
+        """
+        Forgets the count mismatch of a data object, once it has been extracted again
+        with the record count the datalake lists.
+        """
+        with self._lock, self._conn:
+            self._conn.execute(
+                'DELETE FROM count_mismatches WHERE business_class = ? AND dl_id = ?', (business_class, dl_id)
+            )
+
+    def mismatches(self, business_class: str, run_id: str = None) -> List[tuple]:
+        """
+        Returns the recorded count mismatches of a business class, only those of one
+        run if `run_id` is given, as (dl_id, expected, written) tuples.
+        """
+        where, params = ('AND run_id = ?', (business_class, run_id)) if run_id is not None else ('', (business_class,))
+        with self._lock:
+            return self._conn.execute(
+                f'SELECT dl_id, expected, written FROM count_mismatches WHERE business_class = ? {where} ORDER BY recorded_at',
+                params
+            ).fetchall()
+
+    def clear(self, business_class: str):
+        """
+        Forgets every data object of a business class. Used for full loads.
+        """
+        self.flush()
+        with self._lock, self._conn:
+            self._conn.execute('DELETE FROM object_state WHERE business_class = ?', (business_class,))
+            self._conn.execute('DELETE FROM watermarks WHERE business_class = ?', (business_class,))
+            self._conn.execute('DELETE FROM failures WHERE business_class = ?', (business_class,))
+            self._conn.execute('DELETE FROM count_mismatches WHERE business_class = ?', (business_class,))
+            self._conn.execute('DELETE FROM file_offsets WHERE business_class = ?', (business_class,))
+            self._conn.execute('DELETE FROM history_imports WHERE business_class = ?', (business_class,))
+
+    def close(self):
+        self.flush()
+        with self._lock:
+            self._conn.close()
@@ -1,11 +1,14 @@
 from utilities.aws import s3
 import logging
 import logging.config
-import glob, json, pandas as pd, re, os, definitions as defs, functools, time, datetime
+import glob, json, pandas as pd, re, os, definitions as defs, functools, time, datetime, csv, tempfile
 from config.config import get_config
 from functools import partial
-from typing import List, Callable
+from typing import Dict, List, Callable, Iterable
 import metadata.types
+from utilities.schemawriters import SchemaWriterPool
+from utilities import parquetio, compression, filesplit, recordcount
+from utilities.runcontext import run_context, compute_active_inc_id
 from resources.dictdefinitions import BusinessClassDataBySchema, BusinessClassRecordCount, BusinessClassMetadata, BusinessClassPyType
 
 """
@@ -16,6 +19,10 @@ Many of these functions use values defined in the config/app.config file
 which drives the behavior of the application.
 """
 
+STREAM_CHUNK_SIZE = 1024 * 1024
+STREAM_SPOOL_SIZE = 16 * 1024 * 1024
+MERGE_BUFFER_SIZE = 1024 * 1024
+
 def root_dir() -> str:
     """
     Returns a function that takes in a list of paths and joins them
@@ -35,30 +42,26 @@ def clear_extract_history(business_class: str) -> None:
     else:
         with open(filename, 'w') as f: pass
 
-def bc_record_count_files(business_class: str) -> List[int]:
+def bc_record_count_files(business_class: str, incremental: bool = None) -> List[int]:
     """
-    Returns list of the count of lines in each of a business classes data file by
-    schema.
+    Returns list of the count of records in each of a business classes data file by
+    schema, for the business class's type of load. Files are counted in parallel,
+    up to `count_workers` at once.
+
+    incremental -- True to count the incremental files, False the full load files;
+                   the business class's type of load by default
     """
+    if incremental is None:
+        incremental = is_incremental(business_class)
+    data_by = inc_data_by_schema_filename(business_class) if incremental else data_by_schema_filename(business_class)
+    schemas = get_schemas(business_class)
+    del schemas['0']
 
-    def read_file(filename):
-        with open(filename, 'r', encoding='utf-8') as f:
-            for line in f:
-                yield line.strip()
+    filenames = [data_by(version=version) for version in schemas]
+    filenames = [f for f in filenames if os.path.exists(f) or parquetio.parquet_parts(f)]
+    counts = recordcount.count_files(filenames, workers=get_config().getint('extractions', 'count_workers', fallback=None))
 
-    def count_lines(lines):
-        count = 0
-        for line in lines:
-            count += 1
-        yield count
-
-    tots = []
-    for file in glob.glob(get_config().get('filename_templates', 'bc_data_by_schema').format(business_class=business_class, version='*')):
-        lines = read_file(file)
-        line_count = count_lines(lines)
-        tots.append(next(line_count))
-        
-    return tots
+    return [counts[f] for f in filenames]
 
 def bc_object_props(business_class: str) -> dict:
     with open(get_config().get('filename_templates', 'obj_props').format(business_class=business_class), 'r') as file:
@@ -66,19 +69,25 @@ def bc_object_props(business_class: str) -> dict:
 
     return data_property_counts
 
-def record_count_by_bc(business_class: str) -> BusinessClassRecordCount:
+def record_count_by_bc(business_class: str, expected: int = None, incremental: bool = None) -> BusinessClassRecordCount:
     """
     Compares number of lines in files containing the raw business class data
     to the number of records indicated by the data object property. If these
     counts don't match then there was a problem in the extraction process.
+
+    expected    -- number of records the files should hold; the total of the object
+                   properties file by default
+    incremental -- passed to `bc_record_count_files`
     """
-    tots = bc_record_count_files(business_class)
-    data_property_counts = bc_object_props(business_class)
-        
+    tots = bc_record_count_files(business_class, incremental)
+    if expected is None:
+        data_property_counts = bc_object_props(business_class)
+        expected = sum([record['dl_instance_count'] for record in data_property_counts['fields']])
+
     return {
         'file_extract_record_count': sum(tots),
-        'expected_record_count': sum([record['dl_instance_count'] for record in data_property_counts['fields']]),
-        'match': sum([record['dl_instance_count'] for record in data_property_counts['fields']]) == sum(tots)
+        'expected_record_count': expected,
+        'match': expected == sum(tots)
     }
 
 def get_columns(filepath: str) -> List[str]:
@@ -114,6 +123,35 @@ def format_col_name(col_name: str) -> str:
     """
     return col_name.replace('\n', '').replace('.', '_').replace('[', '').replace(']', '')
 
+def columns_to_extract(business_class: str) -> set:
+    """
+    Returns the columns listed in the columns file of a business class, both as
+    listed and formatted, so they match the raw column names of the datalake.
+    Returns None if the file lists no columns or `project_columns` is off in the
+    `extractions` section, meaning every column is extracted.
+    """
+    if not get_config().getboolean('extractions', 'project_columns', fallback=True):
+        return None
+
+    listed = [col.strip() for col in get_columns(get_config().get('filename_templates', 'columns_to_load').format(business_class=business_class))]
+    listed = [col for col in listed if col]
+    if not listed:
+        return None
+
+    return set(listed) | {format_col_name(col) for col in listed}
+
+def project_columns(columns: List[str], selected: set = None) -> List[str]:
+    """
+    Returns the columns of a schema that are written to its data file, in schema order.
+
+    columns  -- columns of a schema version
+    selected -- columns returned by `columns_to_extract`; None keeps every column
+    """
+    if selected is None:
+        return list(columns)
+
+    return [col for col in columns if col in selected or format_col_name(col) in selected]
+
 def create_columns_file(business_class: str) -> str:
     """
     Creates the file that specifies with columns from a business class
@@ -190,38 +228,61 @@ def remove_data_by_schema_files(business_class: str):
 
     This should be invoked if full extraction is performed.
     """
-    for file in glob.glob(get_config().get('filename_templates', 'bc_data_by_schema').format(business_class=business_class, version='*')):
+    pattern = get_config().get('filename_templates', 'bc_data_by_schema').format(business_class=business_class, version='*')
+    for file in glob.glob(pattern) + glob.glob(pattern + '.*') + glob.glob(os.path.splitext(pattern)[0] + '*.parquet'):
         os.remove(file)
 
-def create_versioned_files(business_class: str) -> List[str]:
+def data_file_sizes(filename: Callable[[str, str], str], business_class: str) -> Dict[str, int]:
     """
-    Creates placeholder csv based on the different schemas of the
-    business class. Returns the list of created files.
+    Returns the size of each data file of a business class, by filename.
+
+    filename -- function returned by `schema_filename_resolver`
     """
+    return {file: os.path.getsize(file) for file in glob.glob(filename(business_class, '*'))}
 
-    data_by = inc_data_by_schema_filename(business_class) if is_incremental(business_class) else data_by_schema_filename(business_class)
-    schemas = get_schemas(business_class)
+def truncate_data_files(filename: Callable[[str, str], str], business_class: str, offsets: Dict[str, int]) -> List[str]:
+    """
+    Truncates the data files of a business class back to the positions recorded
+    at the last checkpoint of an unfinished extraction, so it can be resumed
+    without duplicating the rows written after that checkpoint. The size of every
+    file is recorded when the extraction starts, so files without a recorded
+    position were created after the last checkpoint and are emptied. Returns the
+    files truncated.
 
-    for version, schema in schemas.items():
-        with open(data_by(version=version), 'w', encoding='utf-8') as f: pass
+    filename -- function returned by `schema_filename_resolver`
+    offsets  -- position of the end of each data file, by filename
+    """
+    truncated = []
+    for file in glob.glob(filename(business_class, '*')):
+        position = offsets.get(file, 0)
+        if os.path.getsize(file) > position:
+            os.truncate(file, position)
+            truncated.append(file)
+
+    return truncated
 
-def not_extracted_ids(business_class: str) -> set:
+def create_versioned_files(business_class: str, truncate: bool = True, incremental: bool = None) -> List[str]:
     """
-    Returns the set of data object IDs that have not yet been
-    extracted from the datalake. Useful for performing incremental
-    extracts from the datalake.
+    Creates placeholder csv based on the different schemas of the
+    business class. Returns the list of created files.
 
-    business_class -- the business class to find the ids not yet extracted
+    truncate    -- if False, existing files keep their data (used when resuming an extraction)
+    incremental -- True to create the incremental files, False the full load files;
+                   the business class's type of load by default
     """
-    with open(get_config().get('filename_templates', 'bc_extraction_history').format(business_class=business_class), 'r') as f:
-        extracted_ids = [id.replace('\n', '') for id in f.readlines()]
-    
-    with open(get_config().get('filename_templates', 'obj_props').format(business_class=business_class), 'r') as f:
-        obj_props = json.load(f)
+    if incremental is None:
+        incremental = is_incremental(business_class)
+    data_by = inc_data_by_schema_filename(business_class) if incremental else data_by_schema_filename(business_class)
+    schemas = get_schemas(business_class)
 
-    ids_from_dl = (obj['dl_id'] for obj in obj_props['fields'])
+    for version, schema in schemas.items():
+        if output_format() == parquetio.PARQUET:
+            # Parquet files are created by the writers; a resumed extraction adds a part file.
+            if truncate:
+                parquetio.remove_parquet_parts(data_by(version=version))
+            continue
 
-    return set(ids_from_dl) - set(extracted_ids)
+        with open(data_by(version=version), 'w' if truncate else 'a', encoding='utf-8') as f: pass
 
 def create_filter(property: str):
     """
@@ -253,8 +314,9 @@ def bc_to_csv(business_class: str, schema: str = 1, dest_dir: str = 'datasets')
     dest_dir       -- the desired output location
     """
     schemas = get_schemas(business_class)
-    data = pd.read_csv(get_config().get('filename_templates','bc_data_by_schema')\
-        .format(business_class=business_class, version=schema), names=schemas[str(schema)], encoding='utf-8')
+    columns = project_columns(schemas[str(schema)], columns_to_extract(business_class))
+    data = pd.read_csv(data_filename(get_config().get('filename_templates','bc_data_by_schema')\
+        .format(business_class=business_class, version=schema)), names=columns, encoding='utf-8')
     
     data.to_csv(f'{dest_dir}/{business_class}_v{schema}_data.csv', index=False)
 
@@ -367,15 +429,7 @@ def bc_data_by_schema(business_class: str, bc_data_filename: str = None) -> Busi
     bc_data_filename - string template specifying location of bc data by schema ({business_class}_v{version}.csv)
                        Defaults to `bc_data_by_schema` value in app.config if user does not supply a string template
     """
-    default_filename = partial(get_config().get('filename_templates', 'bc_data_by_schema').format,
-        business_class=business_class
-    )
-
-    inc_filename = partial(get_config().get('filename_templates', 'bc_data_by_schema_inc').format,
-                    bc_folder=business_class,
-                    active_inc_id=get_active_inc_id(),
-                    bc_file=business_class
-                )
+    data_by = inc_data_by_schema_filename(business_class) if is_incremental(business_class) else data_by_schema_filename(business_class)
 
     schemas = get_schemas(business_class=business_class)
     del schemas['0']
@@ -383,59 +437,166 @@ def bc_data_by_schema(business_class: str, bc_data_filename: str = None) -> Busi
     metadata = get_metadata(business_class=business_class)
     dtypes = py_types_from_metadata(metadata)
 
+    # Data files only hold the columns that were extracted.
+    selected = columns_to_extract(business_class)
+
     data = {}
     for version, schema in schemas.items():
-        columns = resolve_col_issues(schema)
-        f = inc_filename(version=version) if is_incremental(business_class) else default_filename(version=version)
-        data[version] = bc_to_df(f, columns=columns, types=dtypes)
+        columns = resolve_col_issues(project_columns(schema, selected))
+        data[version] = bc_to_df(data_by(version=version), columns=columns, types=dtypes)
 
     return data
 
-def bc_merged_csv(business_class: str) -> Callable[[], str]:
+def column_mapping(columns: List[str], output_columns: List[str]) -> List[int]:
+    """
+    Returns, for each output column, the index of that column in `columns`, or
+    `len(columns)` if it is missing so an empty value can be appended at that index.
+
+    columns        -- columns of a data file
+    output_columns -- columns of the merged file
+    """
+    index = {col: i for i, col in enumerate(columns)}
+    return [index.get(col, len(columns)) for col in output_columns]
+
+def bc_merged_csv(business_class: str, incremental: bool = None) -> Callable[[], str]:
     """
     Iterates through all of the csv files by schema for a given business class
     then concatenates the files into one file. Returns the function that can be
-    called to make the csv file.
+    called to make the csv file. Merges the parquet files instead if the output
+    format is parquet.
+
+    Rows are streamed from each file and rearranged into the merged column layout
+    with a precomputed column mapping, so memory use does not grow with the data.
 
     business_class -- the business class to generate the merged csv file for
+    incremental    -- True to merge the incremental files, False the full load files;
+                      the business class's type of load by default
     """
+    if incremental is None:
+        incremental = is_incremental(business_class)
+    if output_format() == parquetio.PARQUET:
+        return bc_merged_parquet(business_class, incremental)
+
+    # Sort the columns alphabetically for reproducibility and troubleshooting
+    output_columns = sorted(resolved_columns(business_class=business_class))
+    data_by = inc_data_by_schema_filename(business_class) if incremental else data_by_schema_filename(business_class)
+    selected = columns_to_extract(business_class)
+
+    schemas = get_schemas(business_class=business_class)
+    del schemas['0']
+
+    # Data files only hold the columns that were extracted.
+    data_files = [
+        (data_by(version=version), column_mapping(resolve_col_issues(project_columns(schema, selected)), output_columns))
+        for version, schema in schemas.items()
+    ]
 
-    all_columns = resolved_columns(business_class=business_class)
-    data = bc_data_by_schema(business_class=business_class)
-    
     def make_csv(filename: str = None) -> str:
         """
         Merges business class data from all schemas into one file and
         returns the filename.
         """
         incremental_filename = inc_data_filename(business_class=business_class)
-        default_filename = get_config().get('filename_templates', 'bc_data_merged').format(business_class=business_class)
-        output_filename = incremental_filename if is_incremental(business_class) else default_filename
+        default_filename = run_context().filename(business_class, 'bc_data_merged')
+        output_filename = data_filename(incremental_filename if incremental else default_filename)
+
+        with compression.open_compressed(output_filename, 'w', newline='', buffering=MERGE_BUFFER_SIZE, **compression_options()) as out:
+            writer = csv.writer(out, lineterminator=os.linesep)
+            writer.writerow(output_columns)
+
+            for version_filename, mapping in data_files:
+                if not os.path.exists(version_filename):
+                    continue
+
+                width = max(mapping, default=0)
+                with compression.open_compressed(version_filename, 'r', newline='', buffering=MERGE_BUFFER_SIZE) as f:
+                    for row in csv.reader(f):
+                        # Pad short rows; the value after the last column is the empty value of missing columns.
+                        # Blank lines hold records without any of the extracted columns and are written as empty rows,
+                        # so the merged file holds every record counted.
+                        row.extend([''] * (width + 1 - len(row)))
+                        writer.writerow([row[i] for i in mapping])
+
+        return output_filename
+
+    return make_csv
+
+def output_format() -> str:
+    """
+    Returns the format business class data is written in: `csv` (default) or `parquet`.
+    """
+    return get_config().get('extractions', 'output_format', fallback=parquetio.CSV)
+
+def output_compression() -> str:
+    """
+    Returns the compression of the business class data files: `none` (default),
+    `gzip` or `zstd`. Csv files get a `.gz` or `.zst` extension; parquet files keep
+    their name and use it as their column compression.
+    """
+    return get_config().get('extractions', 'compression', fallback=compression.NONE)
+
+def compression_options() -> dict:
+    """
+    Returns the compression level and number of threads to write compressed files with.
+    """
+    return {
+        'level': get_config().getint('extractions', 'compression_level', fallback=None),
+        'threads': get_config().getint('extractions', 'compression_threads', fallback=None)
+    }
+
+def data_filename(filename: str) -> str:
+    """
+    Returns the name a csv data file is written under with the configured compression.
+    """
+    if output_format() == parquetio.PARQUET:
+        return filename
+    return compression.compressed_filename(filename, output_compression())
+
+def bc_merged_parquet(business_class: str, incremental: bool = None) -> Callable[[], str]:
+    """
+    Parquet counterpart of `bc_merged_csv`. Merges the parquet files by schema of a
+    business class into one parquet file, reading only the columns to load.
+    """
+    if incremental is None:
+        incremental = is_incremental(business_class)
+    all_columns = resolved_columns(business_class=business_class)
+    data_by = inc_data_by_schema_filename(business_class) if incremental else data_by_schema_filename(business_class)
+    selected = columns_to_extract(business_class)
+
+    schemas = get_schemas(business_class=business_class)
+    del schemas['0']
 
-        # Concatenate each of the individual data files, merging their schemas
-        merged_data_proto = pd.concat([df for df in data.values()])[all_columns]
+    filenames, renamed = {}, {}
+    for version, schema in schemas.items():
+        columns = project_columns(schema, selected)
+        filenames[version] = data_by(version=version)
+        renamed[version] = dict(zip(columns, resolve_col_issues(list(columns))))
 
-        # Sort the columns alphabetically for reproducibility and troubleshooting
-        merged_data = merged_data_proto.reindex(sorted(merged_data_proto.columns), axis=1)
+    def make_parquet(filename: str = None) -> str:
+        incremental_filename = inc_data_filename(business_class=business_class)
+        default_filename = run_context().filename(business_class, 'bc_data_merged')
+        output_filename = parquetio.parquet_filename(incremental_filename if incremental else default_filename)
 
-        # Output to file
-        merged_data.to_csv(output_filename, index=False)
+        # Columns are sorted alphabetically, as in the merged csv
+        merged = parquetio.read_parquet_files(filenames, renamed, sorted(all_columns))
+        parquetio.pq.write_table(merged, output_filename, compression=parquetio.parquet_compression(output_compression()))
 
         return output_filename
 
-    return make_csv
+    return make_parquet
 
 def is_incremental(business_class: str) -> bool:
     """
     Check if business class is configured as incremental or not.
     """
-    filename = get_config().get('filename_templates', 'bc_table_config_map')
-    with open(os.path.join(defs.ROOT_DIR, filename), 'r') as f:
-        data = json.load(f)
+    return run_context().is_incremental(business_class)
 
-        for k, v in data.items():
-            if v['business_class_name'] == business_class:
-                return v['incremental']
+def is_watermarked(business_class: str) -> bool:
+    """
+    Check if business class is configured to list only the data objects
+    newer than its watermark on incremental loads.
+    """
+    return run_context().is_watermarked(business_class)
 
 def write_db_load_payload(business_class: str) -> str:
     """
@@ -447,23 +608,17 @@ def write_db_load_payload(business_class: str) -> str:
     payload['s3_bucket'] = get_config().get('aws', 's3_databrew_bucket_name')
     payload['mode'] = 'replace'
     
-    filename = get_config().get('filename_templates', 'bc_table_config_map')
-    with open(filename, 'r') as f:
-        data = json.load(f)
-
-        for k, v in data.items():
-            if v['business_class_name'] == business_class:
-                payload['target_table'] = f"SCOLumaStaging.dbo.{v['staging_table_name']}"
+    staging_table_name = run_context().staging_table_name(business_class)
+    if staging_table_name:
+        payload['target_table'] = f"SCOLumaStaging.dbo.{staging_table_name}"
         
     if is_incremental(business_class):
         payload['target_file'] = s3_inc_data_filename(business_class).replace('all_schemas', 'cleansed')
     else:
         payload['target_file'] = f'output/{business_class}_cleansed.csv'
+    payload['target_file'] = data_filename(parquetio.output_filename(payload['target_file'], output_format()))
 
-    payload_filename = get_config().get(
-        'filename_templates',
-        'bc_db_tbl_payload'
-    ).format(business_class=business_class)
+    payload_filename = run_context().filename(business_class, 'bc_db_tbl_payload')
     
     with open(payload_filename, 'w') as f:
         f.write(json.dumps(payload))
@@ -476,21 +631,23 @@ def write_push_data_payload(business_class: str) -> bool:
     required to push business class data from local machine
     to s3.
     """
-    get_filename = partial(get_config().get, section='filename_templates')
+    get_filename = partial(run_context().filename, business_class)
     
     if is_incremental(business_class):
         all_schemas_local = inc_data_filename(business_class)
         all_schemas_s3 = f'output/{all_schemas_local}'
     else: 
-        all_schemas_local = get_filename(option='bc_data_merged').format(business_class=business_class)
+        all_schemas_local = get_filename('bc_data_merged')
         all_schemas_s3 = f'output/{business_class}_all_schemas.csv'
+    all_schemas_local = data_filename(parquetio.output_filename(all_schemas_local, output_format()))
+    all_schemas_s3 = data_filename(parquetio.output_filename(all_schemas_s3, output_format()))
 
     payload = {
         'all_schemas': all_schemas_local,
-        'metadata': get_filename(option='bc_metadata_filename').format(bc_name=business_class),
-        'schemas': get_filename(option='schemas').format(business_class=business_class),
-        'extraction_history': get_filename(option='bc_extraction_history').format(business_class=business_class),
-        'db_load_payload': get_filename(option='bc_db_tbl_payload').format(business_class=business_class),
+        'metadata': get_filename('bc_metadata_filename'),
+        'schemas': get_filename('schemas'),
+        'extraction_history': get_filename('bc_extraction_history'),
+        'db_load_payload': get_filename('bc_db_tbl_payload'),
         'all_schemas_s3': all_schemas_s3,
         'metadata_s3': f'output/{business_class}_metadata.json',
         'schemas_s3': f'output/{business_class}_schemas.json',
@@ -498,7 +655,7 @@ def write_push_data_payload(business_class: str) -> bool:
         'db_load_payload_s3': f'output/{business_class}_db_tbl_load_payload.json'
     }
 
-    filename = get_filename(option='bc_push_data_payload').format(business_class=business_class)
+    filename = get_filename('bc_push_data_payload')
     with open(filename, 'w') as f:
         f.write(json.dumps(payload))
 
@@ -515,32 +672,21 @@ def s3_inc_data_filename(business_class: str) -> str:
     return f'{s3_folder}{s3_filename}'
 
 def inc_data_by_schema_filename(business_class: str):
-    by_version = partial(get_config().get('filename_templates', 'bc_data_by_schema_inc').format,
-                    bc_folder=business_class,
-                    active_inc_id=get_active_inc_id(),
-                    bc_file=business_class
-                )
+    by_version = run_context().filename(business_class, 'bc_data_by_schema_inc').format
     
-    return by_version
+    return lambda version: data_filename(by_version(version=version))
 
 def data_by_schema_filename(business_class: str):
-    by_version = partial(get_config().get('filename_templates', 'bc_data_by_schema').format,
-        business_class=business_class
-    )
+    by_version = run_context().filename(business_class, 'bc_data_by_schema').format
     
-    return by_version
+    return lambda version: data_filename(by_version(version=version))
 
 def inc_data_filename(business_class: str) -> str:
     """
     Returns the filename of the incremental data for the a
     given business class and the current, active incremental id.
     """
-    return get_config().get('filename_templates', 'bc_data_merged_inc')\
-        .format(
-            bc_folder=business_class,
-            active_inc_id=get_active_inc_id(),
-            business_class=business_class
-        )
+    return run_context().filename(business_class, 'bc_data_merged_inc')
     
 def create_inc_folders_s3(business_class: str) -> str:
     """
@@ -595,47 +741,161 @@ def filter_transaction_amounts(val):
 
     return float(val)
 
-def process_val(val) -> str:
+class _RowList(list):
     """
-    Removes some characters from a string that causes problems when loading
-    into a pandas dataframe using a csv file.
+    List that a csv writer can write to. The writer makes one `write` call per
+    row, so each row ends up as one string in the list.
     """
-    val = f'"{val}"'
-    val = val.replace('"', '')
-    val = val.replace('\n', '')
+    write = list.append
 
-    return f'"{val}"'
+def _csv_writer(f):
+    return csv.writer(f, quoting=csv.QUOTE_ALL, lineterminator='\n')
+
+def encode_rows(rows: Iterable[tuple]) -> List[str]:
+    """
+    Formats rows of values as csv lines in one call. Every value is quoted and
+    embedded quotes are doubled (RFC 4180); None is written as an empty value.
+    Returns one string per row, each ending with a newline.
+
+    rows -- tuples of values, e.g. from `SchemaRegistry.values`
+    """
+    lines = _RowList()
+    _csv_writer(lines).writerows(rows)
+    return lines
+
+def row_encoder() -> Callable[[tuple], str]:
+    """
+    Returns a function that formats a single row of values like `encode_rows`,
+    reusing one csv writer for rows that are written as they are parsed.
+    """
+    lines = _RowList()
+    writer = _csv_writer(lines)
+
+    def encode(values: tuple) -> str:
+        writer.writerow(values)
+        return lines.pop()
+
+    return encode
+
+def schema_filename_resolver(filenames: dict, incremental_load: bool, full_load: bool) -> Callable[[str, str], str]:
+    """
+    Returns a function that takes a business class and a schema version and returns
+    the file the version's data is written to for the type of load. Returns None if
+    neither load type is set. The active incremental id is resolved once, when the
+    resolver is created, so it stays the same for the whole extraction.
+
+    filenames        -- the filename_templates section of the config file
+    incremental_load -- True if performing an incremental load
+    full_load        -- True if performing a full load
+    """
+    if incremental_load:
+        by_version = partial(filenames['bc_data_by_schema_inc'].format, active_inc_id=get_active_inc_id())
+        return lambda business_class, version: data_filename(by_version(bc_folder=business_class, bc_file=business_class, version=version))
+
+    if full_load:
+        by_version = filenames['bc_data_by_schema'].format
+        return lambda business_class, version: data_filename(by_version(business_class=business_class, version=version))
+
+    return None
 
 def write_to_schema_file(func):
     def wrapper(self, *args, **kwargs):
         data_to_write = func(self, *args, **kwargs)      
 
-        def write(filename, schema, records):
-            logging.debug(f'Writing {len(records)} records to {filename}')
-            with open(filename, 'a', encoding='utf-8') as f:
-                for record in records:
-                    f.write(record[0])
-        
-        if data_to_write:
-            del data_to_write['0']
-            for schema, records in data_to_write.items():
-                fl_filename = self.filenames['bc_data_by_schema']\
-                    .format(business_class=self.curr_bc.name, version=schema)
-                il_filename = self.filenames['bc_data_by_schema_inc']\
-                    .format(
-                        bc_folder=f'{self.curr_bc.name}', 
-                        active_inc_id=get_active_inc_id(), 
-                        bc_file=f'{self.curr_bc.name}',
-                        version=schema
-                    )
-                
-                write_to = partial(write, schema = schema, records = records)
+        """
+        Returns the schema versions that records were written to.
+        """
+        written = set()
+        if data_to_write is None:
+            return []
+
+        # Use the writers kept open for the whole extraction if there are any.
+        writers = getattr(self, 'writers', None)
+        own_writers = writers is None
+        if own_writers:
+            filename = schema_filename_resolver(self.filenames, self.opts.incremental_load, self.opts.full_load)
+            if not filename:
+                return []
+            writers = SchemaWriterPool(filename, compression_options=compression_options())
 
-                if self.opts.incremental_load: write_to(il_filename)
-                elif self.opts.full_load: write_to(fl_filename)
+        try:
+            if isinstance(data_to_write, dict):
+                del data_to_write['0']
+                for schema, records in data_to_write.items():
+                    logging.debug(f'Writing {len(records)} records to schema {schema}')
+                    if writers.write(self.curr_bc.name, schema, records):
+                        written.add(schema)
+            else:
+                # Streamed (schema, row) pairs; each row is written as soon as it is parsed.
+                for schema, row in data_to_write:
+                    if schema != '0':
+                        writers.write(self.curr_bc.name, schema, (row,))
+                        written.add(schema)
+        finally:
+            if own_writers:
+                writers.close()
+
+        return sorted(written, key=int)
             
     return wrapper
 
+class SpooledResponse:
+    """
+    Body of a streamed datalake response read into a temporary file, which stays in
+    memory up to `max_size` bytes and spills to disk past it. The body is read by the
+    thread that downloads the object, so downloads keep overlapping while the main
+    thread parses an earlier object, and whole bodies are not held in memory.
+
+    response -- response sent with `stream=True`; closed once its body is read
+    max_size -- most bytes of the body kept in memory
+    """
+    def __init__(self, response, max_size: int = STREAM_SPOOL_SIZE):
+        self.status_code = response.status_code
+        self.url = response.url
+        self._body = tempfile.SpooledTemporaryFile(max_size=max_size)
+        try:
+            for chunk in response.iter_content(chunk_size=STREAM_CHUNK_SIZE):
+                self._body.write(chunk)
+            self._body.seek(0)
+        except BaseException:
+            self._body.close()
+            raise
+        finally:
+            response.close()
+
+    @property
+    def text(self) -> str:
+        self._body.seek(0)
+        return self._body.read().decode('utf-8')
+
+    def iter_lines(self, chunk_size: int = None, delimiter: bytes = None):
+        for line in self._body:
+            yield line[:-1] if line.endswith(b'\n') else line
+
+    def close(self):
+        self._body.close()
+
+def response_records(response, stream: bool = False):
+    """
+    Yields the records of a datalake NDJSON response. When streaming, lines are read
+    from the spooled body one at a time so only one record is held in memory at a time.
+    The datalake always returns UTF-8, so no charset detection is done.
+
+    response -- response from the datalake stream by id endpoint
+    stream   -- True if the request was sent with `stream=True`
+    """
+    try:
+        if stream:
+            lines = response.iter_lines(chunk_size=STREAM_CHUNK_SIZE, delimiter=b'\n')
+        else:
+            lines = response.content.split(b'\n')
+
+        for line in lines:
+            if line.strip():
+                yield json.loads(line.decode('utf-8'))
+    finally:
+        response.close()
+
 def extract(func):
     def wrapper(self, *args, **kwargs):
         """
@@ -646,60 +906,69 @@ def extract(func):
 
         # Response from datalake
         datalake_response = func(self, *args, **kwargs)
-        response_str = datalake_response.content.decode(encoding=datalake_response.apparent_encoding).strip()
+        stream = self.opts.stream_responses
 
         if datalake_response.status_code != 200:
-            error_msg = f'Error sending request to datalake for {response_str}'
+            error_msg = f'Error sending request to datalake for {datalake_response.text.strip()}'
             logging.error(f"Something wrong with API call to datalake for url: {datalake_response.url}")
             logging.error(error_msg)
+            datalake_response.close()
             raise Exception(error_msg)
-        
-        # Create generator from datalake response
+
+        """
+        The schema registry of the current business class is used to compare
+        to the schemas of the incoming records in the datalake's response.
+        The registry is updated any time a new schema is detected.
+        """
+        registry = self.curr_bc.registry
+
+        def values_by_schema(records):
+            for record in records:
+                schema_count = len(registry)
+                record_schema = registry.version(record)
+                if len(registry) > schema_count:
+                    logging.debug('New schema found')
+
+                # Values are emitted in the column order stored for the schema.
+                yield record_schema, registry.values(record_schema, record)
+
+        records = response_records(datalake_response, stream=stream)
+
+        if stream:
+            """
+            Returns a generator of (schema, row) pairs which is consumed line by line from
+            the spooled body. A body that fails to parse part way may leave the rows parsed
+            before the failure in the schema files.
+            """
+            self.data = None
+            encode = row_encoder()
+            return ((schema, encode(values)) for schema, values in values_by_schema(records))
+
+        # Create list of records from datalake response
         try:
-            record_data = response_str.split('\n')
-            self.data = [json.loads(record) for record in record_data if len(record) > 0]
+            self.data = list(records)
         except Exception as e:
             logging.error("Bad Data")
             logging.error(e)
-            logging.debug(response_str)
-            raise Exception(error_msg)
-        else:
-            """
-            This set of schemas for the current business class is used to compare
-            to the schemas of the incoming records in the datalake's response.
-            This set is updated any time a new schema is detected.
-            """
-            set_of_schemas = [set(schema) for schema in self.curr_bc.schemas.values()]
-            records_by_schema = {}
-            for schema in self.curr_bc.schemas.keys():
-                records_by_schema[schema] = []
-
-            for record in self.data:
-                record_schema = None
-
-                # Check if current records schemas already exists in the master list.
-                record_keys = {key for key in record.keys()}
-                if record_keys in set_of_schemas:
-                    record_schema = f'{set_of_schemas.index(record_keys)}'
-                else:
-                    # New schema found
-                    logging.debug('New schema found')
-                    max_schema_key = max([int(key) for key in self.curr_bc.schemas.keys()])
-                    newest_schema_number = f'{max_schema_key + 1}'
-                    self.curr_bc.schemas[newest_schema_number] = list(record.keys())
-                    records_by_schema[newest_schema_number] = []
-                    set_of_schemas.append(set(record.keys()))
+            raise Exception(f'Bad data in datalake response for url: {datalake_response.url}')
 
-                row_to_write = ','.join(list(map(process_val, record.values())))
-                records_by_schema[record_schema or newest_schema_number].append([row_to_write + '\n'])
+        values = {}
+        for schema in self.curr_bc.schemas.keys():
+            values[schema] = []
 
-            """
-            Returns a dict where the key is the schema and the value are the datalake
-            records assigned to that schema. This is important to do because for a given
-            data object (collection of business class records), more than one schema could
-            exist.
-            """
-            return records_by_schema
+        for schema, record_values in values_by_schema(self.data):
+            values.setdefault(schema, []).append(record_values)
+
+        # The rows of each schema are formatted in one call.
+        records_by_schema = {schema: encode_rows(rows) for schema, rows in values.items()}
+
+        """
+        Returns a dict where the key is the schema and the value are the datalake
+        records assigned to that schema. This is important to do because for a given
+        data object (collection of business class records), more than one schema could
+        exist.
+        """
+        return records_by_schema
 
     return wrapper
 
@@ -708,39 +977,19 @@ def write_inc_schedule(filename, start_datetime, n=100):
         for i in range(1, n + 1):
             f.write(f'{start_datetime + (86400 * i)}\n')
 
-def split_file(source_filename: str, num_output_files: int):
+def split_file(source_filename: str, num_output_files: int, header: bool = False) -> List[str]:
     """
-    Splits a single file into multiple, evenly sized files.
+    Splits a single file into multiple, evenly sized files that each hold whole
+    records. Parts are copied in parallel.
 
     source_filename - name of file to split
     num_output_files - number of files to split the source file into
+    header - True to repeat the header row of the source file in every part
     """
-    file_size_gb = lambda fn: os.path.getsize(fn) / 1e9
-    output_filesize_max = file_size_gb(source_filename) / num_output_files
-
-    output_filenames = []
-    source_fn_base, ext = source_filename.split('.')
-    for i in range(1, num_output_files + 1):
-        output_filenames.append(f"{source_fn_base}_{i}.{ext}")
-
-    def read_file(filename):
-        with open(filename, 'r', encoding='utf-8') as f:
-            for line in f:
-                yield line
-
-    lines = read_file(source_filename)
-    for f in output_filenames:
-        curr_file = open(f, 'w', encoding='utf-8')
-        while file_size_gb(f) < output_filesize_max:
-            try:
-                curr_file.write(next(lines))
-            except StopIteration as e:
-                curr_file.close()
-                break
-        else:
-            curr_file.close()
+    source_fn_base, ext = os.path.splitext(source_filename)
+    output_filenames = [f"{source_fn_base}_{i}{ext}" for i in range(1, num_output_files + 1)]
 
-    return output_filenames
+    return filesplit.split(source_filename, output_filenames, header=header)
 
 def bc_config_summary(business_class: str) -> dict:
     class ETLConfig:
@@ -790,22 +1039,14 @@ def bc_config_summary(business_class: str) -> dict:
     return results
 
 def get_active_inc_id(cutoff_hour=None):
-    if get_config().get('inc_extraction', 'active_inc_id_override'):
-        return get_config().getint('inc_extraction', 'active_inc_id_override')
-
-    if not cutoff_hour:
-        cutoff_hour = int(get_config().get('inc_extraction', 'cutoff_hour'))
-
-    curr = datetime.datetime.now().timestamp()
-    mountain_time = curr - 21600 # Go back 6 hours to get to mountain time
-    curr = datetime.datetime.fromtimestamp(mountain_time)
-
-    y,m,d,h = (curr.year,
-            curr.month,
-            curr.day,
-            curr.hour)
+    """
+    Returns the active incremental id, frozen when the run started. Computed
+    afresh if a `cutoff_hour` is given.
+    """
+    if cutoff_hour:
+        return compute_active_inc_id(cutoff_hour=cutoff_hour)
 
-    return int((datetime.datetime(y,m,d,5,0,0).timestamp()) - (86400 if h < (cutoff_hour) else 0))
+    return run_context().active_inc_id
 
 def timer(func):
     """